@@ -1,12 +1,39 @@
 import hashlib
 
+#legacy: int digests of UTF-8 text, interior nodes hash the decimal text of left + right
+HASH_VERSION_LEGACY = 0
+#binary: 32-byte digests with domain-separated leaves and nodes, interior nodes hash left || right
+HASH_VERSION_BINARY = 1
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+PATH_BITS = 256
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def _to_bytes(data):
+    return data.encode('utf-8') if isinstance(data, str) else data
+
 
 def sha256(data):
     hex_hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
     int_hash = int(hex_hash, 16)
     return int_hash
 
-def get_binary_hash(data):
+def leaf_hash(data):
+    return hashlib.sha256(LEAF_PREFIX + _to_bytes(data)).digest()
+
+def node_hash(left_hash, right_hash):
+    return hashlib.sha256(NODE_PREFIX + left_hash + right_hash).digest()
+
+def get_binary_hash(data, version=HASH_VERSION_LEGACY):
+    """
+    Leaf address of data: a 256-character '0'/'1' string in the legacy version,
+    a 256-bit int path in the binary version.
+    """
+    if version == HASH_VERSION_BINARY:
+        return int.from_bytes(hashlib.sha256(_to_bytes(data)).digest(), byteorder="big")
+
     hex_hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
 
     binary_hash = bin(int(hex_hash, 16))[2:]
@@ -15,7 +42,58 @@ def get_binary_hash(data):
 
     return binary_hash
 
-if __name__ == "__main__":   
+def hash_leaf_stream(source, chunk_size=HASH_CHUNK_SIZE, length=None):
+    """
+    leaf_hash(data) and get_binary_hash(data, HASH_VERSION_BINARY) in one pass over data.
+    source is bytes, bytearray, memoryview, str or a binary file-like object; it is fed
+    to both hashes chunk by chunk, without copying buffers and without reading files whole.
+    With length, exactly that many bytes are hashed from a file-like object (from its
+    current position) or a bytes-like source; ValueError if the source is shorter.
+    """
+    leaf = hashlib.sha256(LEAF_PREFIX)
+    content = hashlib.sha256()
+
+    if hasattr(source, 'readinto') or hasattr(source, 'read'):
+        remaining = -1 if length is None else length
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while remaining:
+            size = chunk_size if remaining < 0 else min(chunk_size, remaining)
+            if hasattr(source, 'readinto'):
+                n = source.readinto(view[:size])
+                chunk = view[:n]
+            else:
+                chunk = source.read(size)
+                n = len(chunk)
+            if not n:
+                break
+            leaf.update(chunk)
+            content.update(chunk)
+            if remaining > 0:
+                remaining -= n
+        if remaining > 0:
+            raise ValueError("Source ended {} bytes short of length".format(remaining))
+    elif isinstance(source, str):
+        if length is not None:
+            raise ValueError("length is not supported for str sources")
+        #UTF-8 encoding chunk by chunk yields the same bytes as encoding the whole string
+        for i in range(0, len(source), chunk_size):
+            chunk = source[i:i + chunk_size].encode('utf-8')
+            leaf.update(chunk)
+            content.update(chunk)
+    else:
+        view = memoryview(source).cast('B')
+        if length is not None:
+            if length > len(view):
+                raise ValueError("Source ended {} bytes short of length".format(length - len(view)))
+            view = view[:length]
+        for i in range(0, len(view), chunk_size):
+            leaf.update(view[i:i + chunk_size])
+            content.update(view[i:i + chunk_size])
+
+    return leaf.digest(), int.from_bytes(content.digest(), byteorder="big")
+
+if __name__ == "__main__":
     data1 = "test1"
     test1 = sha256(data1)
     print(test1)
@@ -23,11 +101,15 @@ if __name__ == "__main__":
     data2 = "test2"
     test2 = sha256(data2)
     print(test2)
-    
+
     test3 = sha256(str(test1 + test2))
     print(test3)
     binary_representation = get_binary_hash(data1)
-    
+
     print("SHA-256 Hash in binary (bit representation):")
     print(binary_representation)
-    print(f"Length of binary representation: {len(binary_representation)} bits")
\ No newline at end of file
+    print(f"Length of binary representation: {len(binary_representation)} bits")
+
+    test4 = node_hash(leaf_hash(data1), leaf_hash(data2))
+    print(test4.hex())
+    print(f"Binary path: {get_binary_hash(data1, HASH_VERSION_BINARY):064x}")
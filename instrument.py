@@ -0,0 +1,175 @@
+import threading
+from functools import wraps
+from time import perf_counter
+from typing import Callable, Optional
+
+from bplib.bp import BpGroup, G1Elem, G2Elem
+
+#(class, method, op name) of every curve operation that is counted
+CURVE_OPS = (
+    (BpGroup, 'hashG1', 'hashG1'),
+    (BpGroup, 'pair', 'pair'),
+    (G1Elem, 'mul', 'mul'),
+    (G1Elem, 'double', 'double'),
+    (G1Elem, 'add', 'add'),
+    (G1Elem, 'export', 'export'),
+    (G1Elem, 'from_bytes', 'from_bytes'),
+    (G2Elem, 'mul', 'g2_mul'),
+    (G2Elem, 'export', 'g2_export'),
+    (G2Elem, 'from_bytes', 'g2_from_bytes'),
+)
+#ops outside of any protocol phase
+NO_PHASE = 'other'
+
+_active = None
+_originals = {}
+
+
+class Profiler:
+    """
+    Counts curve operations and the time spent in them, per protocol phase.
+
+    enable() wraps the bplib methods in CURVE_OPS, disable() puts the originals back, so
+    nothing is paid while no profiler is enabled; only one profiler can be enabled at a
+    time. Phases are opened by the Purchaser and Seller methods given a profiler (see
+    profiled) and nest, an op being charged to the innermost one. Ops called by another
+    counted op (e.g. a double inside mul) are part of the outer op. If sink is given it
+    is called as sink(phase, op, seconds) after each op. Work done in the process pool
+    of Seller.attr_issue(workers=...) is not seen.
+    """
+
+    def __init__(self, sink:Optional[Callable[[str, str, float], None]]=None):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        #phase -> [calls, seconds], phase -> op -> [count, seconds]
+        self.phases = {}
+        self.ops = {}
+
+    def enable(self):
+        global _active
+        if _active is not None and _active is not self:
+            raise ValueError("Another Profiler is already enabled")
+        if _active is None:
+            for cls, name, op in CURVE_OPS:
+                #the method may be inherited; look it up the MRO but patch cls itself
+                owner = next(base for base in cls.__mro__ if name in base.__dict__)
+                original = owner.__dict__[name]
+                _originals[(cls, name)] = original if owner is cls else None
+                setattr(cls, name, self._wrap(original, op))
+            _active = self
+
+    def disable(self):
+        global _active
+        if _active is not self:
+            return
+        for (cls, name), original in _originals.items():
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        _originals.clear()
+        _active = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _wrap(self, original, op):
+        descriptor = type(original) if isinstance(original, (staticmethod, classmethod)) else None
+        fn = original.__func__ if descriptor else original
+        local = self._local
+
+        @wraps(fn)
+        def counted(*args, **kwargs):
+            if getattr(local, 'busy', False):
+                return fn(*args, **kwargs)
+            local.busy = True
+            t0 = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - t0
+                local.busy = False
+                self._record_op(op, elapsed)
+
+        return descriptor(counted) if descriptor else counted
+
+    def _record_op(self, op, seconds):
+        stack = self._stack()
+        phase = stack[-1] if stack else NO_PHASE
+        with self._lock:
+            entry = self.ops.setdefault(phase, {}).setdefault(op, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        if self.sink is not None:
+            self.sink(phase, op, seconds)
+
+    def begin_phase(self, phase):
+        self._stack().append(phase)
+        return perf_counter()
+
+    def end_phase(self, phase, t0):
+        seconds = perf_counter() - t0
+        self._stack().pop()
+        with self._lock:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def stats(self) -> dict:
+        """
+        {phase: {'calls', 'seconds', 'ops': {op: {'count', 'seconds'}}}}. A phase's seconds
+        include its nested phases, its ops do not.
+        """
+        with self._lock:
+            result = {}
+            for phase in set(self.phases) | set(self.ops):
+                calls, seconds = self.phases.get(phase, (0, 0.0))
+                result[phase] = {
+                    'calls': calls,
+                    'seconds': seconds,
+                    'ops': {op: {'count': n, 'seconds': t} for op, (n, t) in self.ops.get(phase, {}).items()},
+                }
+            return result
+
+    def report(self) -> str:
+        lines = []
+        for phase, entry in sorted(self.stats().items()):
+            lines.append("{}: {} calls, {:.6f} s".format(phase, entry['calls'], entry['seconds']))
+            for op, op_entry in sorted(entry['ops'].items(), key=lambda item: -item[1]['seconds']):
+                lines.append("    {:<14} {:>10} {:.6f} s".format(op, op_entry['count'], op_entry['seconds']))
+        return '\n'.join(lines)
+
+
+def profiled(phase:str):
+    """
+    Method decorator running the method as phase of self.profiler, if it has one.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            t0 = profiler.begin_phase(phase)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profiler.end_phase(phase, t0)
+        return wrapper
+
+    return decorator
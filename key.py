@@ -1,14 +1,18 @@
 from bplib.bp import BpGroup
 
 class KeyManager:
-    def __init__(self):
+    def __init__(self, key_pool=None):
 
-        self.group = BpGroup()
+        #a pool hands out pairs of its own group
+        self.key_pool = key_pool
+        self.group = key_pool.group if key_pool is not None else BpGroup()
 
     def generate_keys(self):
         """
-        Generate and return a public/private key pair.
+        Generate and return a public/private key pair, taken from the key pool if there is one.
         """
+        if self.key_pool is not None:
+            return self.key_pool.pop()
         private_key = self.group.order().random()
         g2=self.group.g2
         public_key = g2.mul(private_key)
@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+
+from bplib.bp import BpGroup
+
+KEY_POOL_LOW_WATER = 8
+KEY_POOL_HIGH_WATER = 32
+
+
+class KeyPool:
+    """
+    Pool of (private_key, public_key = private_key * g2) pairs generated ahead of time
+    by a background thread, so taking a fresh key pair costs a deque pop instead of a
+    G2 scalar multiplication.
+
+    Whenever pop leaves low_water pairs or fewer, the thread refills the pool up to
+    high_water. If the pool is empty, pop generates a pair inline and counts the pool
+    as dry. The thread works on group itself: bplib keeps no big-number context in the
+    group (every call gets a fresh one), so sharing it is safe and reuses its
+    precomputed multiples of g2.
+
+    Pooled private keys sit in memory until they are used, which lengthens their
+    lifetime by up to high_water pops.
+    """
+
+    def __init__(self, group:BpGroup, low_water:int=KEY_POOL_LOW_WATER, high_water:int=KEY_POOL_HIGH_WATER, start:bool=True):
+        if not 0 <= low_water < high_water:
+            raise ValueError("Need 0 <= low_water < high_water")
+        self.group = group
+        self.low_water = low_water
+        self.high_water = high_water
+
+        self._keys = deque()
+        self._refill = threading.Event()
+        self._closed = False
+        self._thread = None
+
+        self.n_generated = 0
+        self.n_popped = 0
+        self.n_dry = 0
+
+        if start:
+            self.start()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="KeyPool", daemon=True)
+            self._thread.start()
+            self._refill.set()
+
+    def _run(self):
+        order, g2 = self.group.order(), self.group.gen2()
+        while True:
+            self._refill.wait()
+            #cleared before filling so a pop during the fill triggers another pass
+            self._refill.clear()
+            if self._closed:
+                return
+            while len(self._keys) < self.high_water and not self._closed:
+                private_key = order.random()
+                self._keys.append((private_key, g2.mul(private_key)))
+                self.n_generated += 1
+
+    def pop(self):
+        """
+        Take a ready (private_key, public_key) pair.
+        """
+        try:
+            private_key, public_key = self._keys.popleft()
+        except IndexError:
+            self.n_dry += 1
+            private_key = self.group.order().random()
+            public_key = self.group.gen2().mul(private_key)
+        self.n_popped += 1
+
+        if len(self._keys) <= self.low_water:
+            self._refill.set()
+        return private_key, public_key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def metrics(self) -> dict:
+        return {
+            'depth': len(self._keys),
+            'generated': self.n_generated,
+            'popped': self.n_popped,
+            'dry': self.n_dry,
+        }
+
+    def close(self):
+        self._closed = True
+        self._refill.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._keys.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,21 +1,34 @@
 import sys
 import time
+import heapq
+import os
+import random
+import struct
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import blake2b
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from operator import itemgetter
 from math import log2
 
 from petlib.bn import Bn #big number class
 from petlib.ec import EcGroup, EcPt
 #pairing
-from bplib.bp import BpGroup, G1Elem, G2Elem
+from bplib.bp import BpGroup, G1Elem, G2Elem, POINT_CONVERSION_UNCOMPRESSED
 from key import KeyManager
+from keypool import KeyPool
+from instrument import Profiler, profiled
 
 
 CUCKOO_FILTER_CAPACITY_MIN = 1000
 CUCKOO_FILTER_CAPACITY_FRACTION = 0.3
 CUCKOO_FILTER_BUCKET_SIZE = 6
 CUCKOO_FILTER_FINGERPRINT_SIZE = 4
+BATCH_VERIFY_RANDOM_SIZE = 16
 DOC_ID_SIZE = 4
+HASHG1_CACHE_CAPACITY = 100000
+PARALLEL_ISSUE_MIN_TAGS = 10000
+PARALLEL_ISSUE_SHARDS_PER_WORKER = 4
 EC_NID_DEFAULT = 415
 ENCODING_DEFAULT = "utf-8"
 
@@ -24,29 +37,276 @@ def kwd_encode(doc_id:bytes, kwd:bytes) -> bytes:
     return blake2b(doc_id + kwd).digest()
 
 
+def iter_tags(group:BpGroup, secret:Bn, docs:Iterable[List[str]], start_doc_id:int=0, kwd_cache:Optional["HashG1Cache"]=None) -> Iterator[Tuple[int, bytes]]:
+    hashG1 = kwd_cache.hashG1 if kwd_cache is not None else group.hashG1
+
+    for doc_id, kwds in enumerate(docs, start_doc_id):
+        encoded_doc_id = doc_id.to_bytes(DOC_ID_SIZE, byteorder="big")
+        for kwd in kwds:
+            kwd_byte = kwd.encode(ENCODING_DEFAULT)
+            kwd_pt = hashG1(kwd_byte)
+            kwd_enc = kwd_pt.mul(secret)
+            kwd_enc_bytes = kwd_enc.export()
+            kwd_docid_bytes = kwd_encode(encoded_doc_id, kwd_enc_bytes)
+
+            yield (doc_id, kwd_docid_bytes)
+
+
+def issue_tags(group:BpGroup, secret:Bn, docs:List[List[str]], start_doc_id:int=0, kwd_cache:Optional["HashG1Cache"]=None) -> List[Tuple[int, bytes]]:
+    return list(iter_tags(group, secret, docs, start_doc_id, kwd_cache))
+
+
+#per-process group for the attr_issue pool, BpGroup objects cannot be pickled
+_worker_group = None
+
+
+def _issue_worker_init(nid):
+    global _worker_group
+    _worker_group = BpGroup(nid)
+
+
+def _issue_worker(shard):
+    start_doc_id, docs, secret_bytes = shard
+    return issue_tags(_worker_group, Bn.from_binary(secret_bytes), docs, start_doc_id)
+
+
+class HashG1Cache:
+    """
+    Bounded LRU cache of keyword points, keyed by keyword bytes, that a Purchaser and
+    a Seller can share. Points are kept decoded in memory and exported when the cache
+    is saved, so a restarted seller can reload its vocabulary without hashing again.
+    """
+
+    def __init__(self, group:BpGroup, capacity:int=HASHG1_CACHE_CAPACITY, path:Optional[str]=None):
+        self.group = group
+        self.capacity = capacity
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._points = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def hashG1(self, kwd_byte:bytes) -> G1Elem:
+        kwd_pt = self._points.get(kwd_byte)
+        if kwd_pt is not None:
+            self._points.move_to_end(kwd_byte)
+            self.hits += 1
+            return kwd_pt
+
+        self.misses += 1
+        kwd_pt = self.group.hashG1(kwd_byte)
+        self._put(kwd_byte, kwd_pt)
+        return kwd_pt
+
+    def _put(self, kwd_byte, kwd_pt):
+        self._points[kwd_byte] = kwd_pt
+        self._points.move_to_end(kwd_byte)
+        while len(self._points) > self.capacity:
+            self._points.popitem(last=False)
+
+    def __len__(self):
+        return len(self._points)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._points), 'capacity': self.capacity}
+
+    def save(self, path:Optional[str]=None):
+        """
+        Write the cache from least to most recently used, so load() restores the LRU order.
+        Points are written uncompressed, so load() does not recover y with a square root.
+        """
+        path = path or self.path
+        with open(path + ".tmp", 'wb') as fd:
+            for kwd_byte, kwd_pt in self._points.items():
+                pt_bytes = kwd_pt.export(POINT_CONVERSION_UNCOMPRESSED)
+                fd.write(struct.pack(">HB", len(kwd_byte), len(pt_bytes)) + kwd_byte + pt_bytes)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path:Optional[str]=None):
+        path = path or self.path
+        with open(path, 'rb') as fd:
+            data = fd.read()
+
+        pos = 0
+        while pos < len(data):
+            kwd_len, pt_len = struct.unpack_from(">HB", data, pos)
+            pos += 3
+            kwd_byte = data[pos:pos + kwd_len]
+            pos += kwd_len
+            self._put(kwd_byte, G1Elem.from_bytes(data[pos:pos + pt_len], self.group))
+            pos += pt_len
+
+
+class CuckooFilter:
+    """
+    Cuckoo filter over kwd_encode tags (Fan et al., partial-key cuckoo hashing).
+
+    Items are expected to be uniformly distributed digests, so the bucket index
+    and the fingerprint are sliced directly out of the item instead of hashing it again.
+    An all-zero fingerprint marks an empty slot.
+    """
+
+    MAX_KICKS = 500
+    HEADER = struct.Struct(">IBBI")
+
+    def __init__(self, capacity, bucket_size=CUCKOO_FILTER_BUCKET_SIZE, fingerprint_size=CUCKOO_FILTER_FINGERPRINT_SIZE):
+        n_buckets = 1
+        while n_buckets * bucket_size < capacity:
+            n_buckets <<= 1
+
+        self.n_buckets = n_buckets
+        self.bucket_size = bucket_size
+        self.fingerprint_size = fingerprint_size
+        self.count = 0
+        self.table = bytearray(n_buckets * bucket_size * fingerprint_size)
+        self._empty = bytes(fingerprint_size)
+
+    @classmethod
+    def from_tags(cls, tags):
+        capacity = max(CUCKOO_FILTER_CAPACITY_MIN, int(len(tags) * (1 + CUCKOO_FILTER_CAPACITY_FRACTION)))
+        while True:
+            tag_filter = cls(capacity)
+            if all(tag_filter.insert(tag) for tag in tags):
+                return tag_filter
+            capacity *= 2
+
+    def _fingerprint(self, item):
+        fp = bytes(item[8:8 + self.fingerprint_size])
+        if fp == self._empty:
+            fp = self._empty[:-1] + b'\x01'
+        return fp
+
+    def _index(self, item):
+        return int.from_bytes(item[:8], byteorder="big") & (self.n_buckets - 1)
+
+    def _alt_index(self, index, fp):
+        fp_hash = int.from_bytes(blake2b(fp, digest_size=8).digest(), byteorder="big")
+        return (index ^ fp_hash) & (self.n_buckets - 1)
+
+    def _slots(self, index):
+        start = index * self.bucket_size * self.fingerprint_size
+        return range(start, start + self.bucket_size * self.fingerprint_size, self.fingerprint_size)
+
+    def _bucket_find(self, index, fp):
+        fs = self.fingerprint_size
+        for pos in self._slots(index):
+            if self.table[pos:pos + fs] == fp:
+                return pos
+        return -1
+
+    def insert(self, item) -> bool:
+        """
+        Insert a tag. Returns False, leaving the filter unchanged, when it is too full.
+        """
+        fs = self.fingerprint_size
+        fp = self._fingerprint(item)
+        i1 = self._index(item)
+        i2 = self._alt_index(i1, fp)
+
+        for index in (i1, i2):
+            pos = self._bucket_find(index, self._empty)
+            if pos >= 0:
+                self.table[pos:pos + fs] = fp
+                self.count += 1
+                return True
+
+        #relocate existing fingerprints, remembering every swap so a failure can be undone
+        swaps = []
+        index = random.choice((i1, i2))
+        for _ in range(self.MAX_KICKS):
+            pos = random.choice(self._slots(index))
+            victim = bytes(self.table[pos:pos + fs])
+            self.table[pos:pos + fs] = fp
+            swaps.append((pos, victim))
+
+            fp = victim
+            index = self._alt_index(index, fp)
+            pos = self._bucket_find(index, self._empty)
+            if pos >= 0:
+                self.table[pos:pos + fs] = fp
+                self.count += 1
+                return True
+
+        for pos, victim in reversed(swaps):
+            self.table[pos:pos + fs] = victim
+        return False
+
+    def __contains__(self, item) -> bool:
+        fp = self._fingerprint(item)
+        i1 = self._index(item)
+        if self._bucket_find(i1, fp) >= 0:
+            return True
+        return self._bucket_find(self._alt_index(i1, fp), fp) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(self.n_buckets, self.bucket_size, self.fingerprint_size, self.count) + bytes(self.table)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < cls.HEADER.size:
+            raise ValueError("Malformed cuckoo filter: {} bytes".format(len(data)))
+        n_buckets, bucket_size, fingerprint_size, count = cls.HEADER.unpack_from(data)
+        tag_filter = cls(n_buckets * bucket_size, bucket_size, fingerprint_size)
+        table = data[cls.HEADER.size:]
+        if len(table) != len(tag_filter.table):
+            raise ValueError("Malformed cuckoo filter: expected {} table bytes, got {}".format(len(tag_filter.table), len(table)))
+        tag_filter.table[:] = table
+        tag_filter.count = count
+        return tag_filter
+
+
+class PublishedIndex:
+    """
+    Exact hash index over the published (doc_id, tag) list, built once and reused across queries.
+    """
+
+    def __init__(self, published:List[Tuple[int, bytes]]):
+        self.tags = set()
+        self.n_docs = 0
+        for doc_id, tag in published:
+            self.tags.add(tag)
+            if doc_id >= self.n_docs:
+                self.n_docs = doc_id + 1
+
+    def __contains__(self, tag) -> bool:
+        return tag in self.tags
+
+    def __len__(self):
+        return len(self.tags)
+
+
 class Purchaser:
 
-    def __init__(self, number_docs_published,group: BpGroup,g1:G1Elem,g2:G2Elem):
+    def __init__(self, number_docs_published,group: BpGroup,g1:G1Elem,g2:G2Elem, kwd_cache:Optional[HashG1Cache]=None, profiler:Optional[Profiler]=None, key_pool:Optional[KeyPool]=None):
 
         self.group = group
         self.g1 = g1
         self.g2 = g2
+        self.kwd_cache = kwd_cache
+        self.profiler = profiler
 
-        key_manager = KeyManager()
+        key_manager = KeyManager(key_pool)
         self.private_key, self.public_key = key_manager.generate_keys()
         self.number_docs_published=number_docs_published
         self.inf=G1Elem.inf(self.group)
         self.ord=self.group.order()
 
+    @profiled('require_issue')
     def require_issue(self, kwds:List[str]) -> Tuple[Bn, List[bytes], G1Elem,G2Elem]:
 
         #secret c
         secret = self.group.order().random()
 
         query_enc = list()
+        hashG1 = self.kwd_cache.hashG1 if self.kwd_cache is not None else self.group.hashG1
 
         for kwd in kwds:
-            kwd_pt = self.group.hashG1(kwd.encode(ENCODING_DEFAULT))
+            kwd_pt = hashG1(kwd.encode(ENCODING_DEFAULT))
             kwd_enc = kwd_pt.mul(secret)
             kwd_enc_bytes = kwd_enc.export()
             query_enc.append(kwd_enc_bytes)
@@ -59,7 +319,14 @@ class Purchaser:
         return (secret, query_enc,sigma_b,self.public_key)
 
 
-    def attr_comfirm(self, secret:Bn, reply:List[Bn], published:List[Tuple[int, bytes]], powers: List[List[G1Elem]]) -> List[int]:
+    @profiled('attr_comfirm')
+    def attr_comfirm(self, secret:Bn, reply:List[Bn], published:Union[List[Tuple[int, bytes]], PublishedIndex, bytes, CuckooFilter], powers: Optional[List[List[G1Elem]]] = None, top_k:Optional[int]=None) -> Union[List[int], List[Tuple[int, int]]]:
+        """
+        Return the number of query keywords matched by every published document, or
+        the top_k (doc_id, n_matches) pairs by match count. Pass a PublishedIndex to
+        reuse the exact tag index across queries. Without powers every reply point is
+        unblinded directly with secret^-1.
+        """
     # def attr_comfirm(self, secret: Bn, reply: List[Bn], published: List[Tuple[int, bytes]]) -> List[int]:
 
         secret_inv = secret.mod_inverse(self.ord)#C
@@ -80,7 +347,11 @@ class Purchaser:
         count=0
         # powers=[]
         for kwd_h in reply:
-            # kwd_pt = G1Elem.from_bytes(kwd_h, self.group)
+            if powers is None:
+                kwd_pt = G1Elem.from_bytes(kwd_h, self.group)
+                kwds_dec.append(kwd_pt.mul(secret_inv).export())
+                continue
+
             T = self.inf
 
             # power_row = []
@@ -96,8 +367,8 @@ class Purchaser:
             # powers.append(power_row)
 
             for j in range(len(secret_inv_bit)):
-                if secret_inv_bit[len(secret_inv_bit)-j-1]:
-                    T.add(powers[count][j])
+                if secret_inv_bit[len(secret_inv_bit)-j-1] == '1':
+                    T = T.add(powers[count][j])
 
 
             kwd_pt_dec=T
@@ -106,15 +377,23 @@ class Purchaser:
 
             count += 1
 
-        # n_docs = max(doc_id for doc_id, _ in published) + 1
-        # for doc_id in range(n_docs):
-        #     n_matches = 0
-        #     encoded_doc_id = doc_id.to_bytes(DOC_ID_SIZE, byteorder="big")
-        #     for kwd_dec in kwds_dec:
-        #         kwd_docid_bytes = kwd_encode(encoded_doc_id, kwd_dec)
-        #         if any(kwd_docid_bytes == pub_kwd for pub_doc_id, pub_kwd in published if pub_doc_id == doc_id):
-        #             n_matches += 1
-        #     cardinalities.append(n_matches)
+        if isinstance(published, (bytes, bytearray)):
+            published = CuckooFilter.from_bytes(published)
+        if isinstance(published, CuckooFilter):
+            #probabilistic path: false positives are possible
+            tag_index, n_docs = published, self.number_docs_published
+        else:
+            tag_index = published if isinstance(published, PublishedIndex) else PublishedIndex(published)
+            n_docs = tag_index.n_docs
+
+        #tags already bind the doc_id, so one lookup per (doc, keyword) is enough
+        for doc_id in range(n_docs):
+            encoded_doc_id = doc_id.to_bytes(DOC_ID_SIZE, byteorder="big")
+            n_matches = sum(kwd_encode(encoded_doc_id, kwd_dec) in tag_index for kwd_dec in kwds_dec)
+            cardinalities.append(n_matches)
+
+        if top_k is not None:
+            return heapq.nlargest(top_k, enumerate(cardinalities), key=itemgetter(1))
 
         return cardinalities
 
@@ -122,76 +401,238 @@ class Purchaser:
 class Seller:
 
 
-    def __init__(self, number_docs_published,group: BpGroup,g1:G1Elem,g2:G2Elem):
+    def __init__(self, number_docs_published,group: BpGroup,g1:G1Elem,g2:G2Elem, kwd_cache:Optional[HashG1Cache]=None, profiler:Optional[Profiler]=None, key_pool:Optional[KeyPool]=None):
 
         self.group = group
         self.g1 = g1
         self.g2 = g2
+        self.kwd_cache = kwd_cache
+        self.profiler = profiler
 
-        key_manager = KeyManager()
+        key_manager = KeyManager(key_pool)
         self.private_key, self.public_key = key_manager.generate_keys()
         self.number_docs_published = number_docs_published
         self.ord=self.group.order()
 
 
-    def attr_issue(self, docs:List[List[str]]) -> Tuple[Bn, List[Tuple[int, bytes]], Bn]:
+    @profiled('attr_issue')
+    def attr_issue(self, docs:List[List[str]], cuckoo:bool=False, workers:Optional[int]=None) -> Tuple[Bn, Union[List[Tuple[int, bytes]], bytes], Bn]:
+        """
+        Blind and tag every document keyword. With cuckoo=True the tags are published
+        as a serialized CuckooFilter instead of the list of (doc_id, tag) tuples.
+        With workers > 1, documents are sharded across a process pool unless there are
+        fewer than PARALLEL_ISSUE_MIN_TAGS keywords in total. The secret, tags and record
+        hash are kept on the seller so attr_append can extend the catalog later.
+        """
 
         #generate secret s
-        secret = self.group.order().random()
+        self.secret = self.group.order().random()
+        self.tag_collection = []
+        self.tag_filter = CuckooFilter.from_tags([]) if cuckoo else None
+        self.number_docs_published = 0
+        #running hash over pk || doc_id || tag ..., extended by attr_append
+        self._rec_hash = blake2b(self.public_key.export())
 
-        tag_collection=[]
+        _, sigma_rec = self.attr_append(docs, workers)
 
-        for doc_id, kwds in enumerate(docs):
-            encoded_doc_id = doc_id.to_bytes(DOC_ID_SIZE, byteorder="big")
-            for kwd in kwds:
-                kwd_byte=kwd.encode(ENCODING_DEFAULT)
-                kwd_pt = self.group.hashG1(kwd_byte)
-                kwd_enc = kwd_pt.mul(secret)
-                kwd_enc_bytes = kwd_enc.export()
-                kwd_docid_bytes = kwd_encode(encoded_doc_id, kwd_enc_bytes)
+        published = self.tag_filter.to_bytes() if cuckoo else self.tag_collection
+        return (self.secret, published, sigma_rec)
+
+
+    @profiled('attr_append')
+    def attr_append(self, docs:List[List[str]], workers:Optional[int]=None) -> Tuple[Union[List[Tuple[int, bytes]], bytes], G1Elem]:
+        """
+        Publish more documents after attr_issue without re-blinding the catalog: only the
+        new documents are tagged, with the existing secret and doc_ids continuing the
+        existing numbering. Returns the new (doc_id, tag) tuples, or the whole updated
+        filter in cuckoo mode, and the refreshed sigma_rec.
+        """
 
-                tag_collection.append((doc_id, kwd_docid_bytes))
+        if self.tag_collection is None:
+            raise ValueError("The catalog is published as a stream; use attr_append_stream")
 
-        #record
-        rec = self.public_key.export() + b''.join(
+        start_doc_id = self.number_docs_published
+        new_tags = self._issue(docs, start_doc_id, workers)
+
+        self.tag_collection.extend(new_tags)
+        self.number_docs_published += len(docs)
+        self._rec_hash.update(b''.join(
             doc_id.to_bytes(DOC_ID_SIZE, byteorder="big") + kwd_docid_bytes
-            for doc_id, kwd_docid_bytes in tag_collection
-        ) + self.number_docs_published.to_bytes(4, byteorder="big")
+            for doc_id, kwd_docid_bytes in new_tags
+        ))
 
-        #sigma_rec
-        rec_g1 = self.group.hashG1(rec)
-        sigma_rec = rec_g1.mul(self.private_key)
+        if self.tag_filter is not None:
+            if not all(self.tag_filter.insert(tag) for _, tag in new_tags):
+                self.tag_filter = CuckooFilter.from_tags([tag for _, tag in self.tag_collection])
+            return (self.tag_filter.to_bytes(), self._sign_record())
+
+        return (new_tags, self._sign_record())
+
+
+    @profiled('attr_issue')
+    def attr_issue_stream(self, docs:Iterable[List[str]], sink) -> Tuple[Bn, G1Elem]:
+        """
+        Like attr_issue, but tags are handed to sink as they are produced and never kept,
+        so memory stays constant however many documents are published. docs may be any
+        iterable. sink is either a file-like object, which receives the fixed-size
+        doc_id || tag records, or a callable taking (doc_id, tag).
+        """
+
+        #generate secret s
+        self.secret = self.group.order().random()
+        self.tag_collection = None
+        self.tag_filter = None
+        self.number_docs_published = 0
+        self._rec_hash = blake2b(self.public_key.export())
+
+        sigma_rec = self.attr_append_stream(docs, sink)
+
+        return (self.secret, sigma_rec)
+
+
+    @profiled('attr_append')
+    def attr_append_stream(self, docs:Iterable[List[str]], sink) -> G1Elem:
+        """
+        Streaming counterpart of attr_append. Returns the refreshed sigma_rec.
+        """
+
+        write = sink.write if hasattr(sink, 'write') else None
+        n_docs = 0
+
+        def counted(docs):
+            nonlocal n_docs
+            for kwds in docs:
+                n_docs += 1
+                yield kwds
 
-        return (secret, tag_collection, sigma_rec)
+        for doc_id, kwd_docid_bytes in iter_tags(self.group, self.secret, counted(docs), self.number_docs_published, self.kwd_cache):
+            record = doc_id.to_bytes(DOC_ID_SIZE, byteorder="big") + kwd_docid_bytes
+            self._rec_hash.update(record)
+            if write is not None:
+                write(record)
+            else:
+                sink(doc_id, kwd_docid_bytes)
 
+        self.number_docs_published += n_docs
+        if self.tag_collection is not None:
+            #streamed tags are not retained, so the in-memory catalog is no longer complete
+            self.tag_collection = None
+            self.tag_filter = None
 
-    # def require_response(self, secret:Bn, query:List[bytes], sigma_b: G1Elem, purchaser_pk:G2Elem) -> List[Bn]:#Tuple[List[Bn], List[List[G1Elem]]]:
-    def require_response(self, secret: Bn, query: List[bytes], sigma_b: G1Elem, purchaser_pk: G2Elem) -> Tuple[List[Bn], List[List[G1Elem]]]:
+        return self._sign_record()
+
+
+    def _issue(self, docs:List[List[str]], start_doc_id:int, workers:Optional[int]) -> List[Tuple[int, bytes]]:
+
+        n_tags = sum(len(kwds) for kwds in docs)
+        if workers is None or workers <= 1 or n_tags < PARALLEL_ISSUE_MIN_TAGS:
+            return issue_tags(self.group, self.secret, docs, start_doc_id, kwd_cache=self.kwd_cache)
+
+        #contiguous shards keep doc_ids and tag order identical to the serial path
+        shard_size = -(-len(docs) // (workers * PARALLEL_ISSUE_SHARDS_PER_WORKER))
+        shards = [(start_doc_id + start, docs[start:start + shard_size], self.secret.binary()) for start in range(0, len(docs), shard_size)]
+        tag_collection = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_issue_worker_init, initargs=(self.group.nid,)) as executor:
+            for chunk in executor.map(_issue_worker, shards):
+                tag_collection.extend(chunk)
+        return tag_collection
+
+
+    @profiled('sign_record')
+    def _sign_record(self) -> G1Elem:
+
+        #record digest
+        n_docs = self.number_docs_published.to_bytes(4, byteorder="big")
+        if self.tag_filter is not None:
+            rec_digest = blake2b(self.public_key.export() + self.tag_filter.to_bytes() + n_docs).digest()
+        else:
+            rec_hash = self._rec_hash.copy()
+            rec_hash.update(n_docs)
+            rec_digest = rec_hash.digest()
+
+        #sigma_rec
+        rec_g1 = self.group.hashG1(rec_digest)
+        return rec_g1.mul(self.private_key)
+
+
+    @profiled('verify_query')
+    def verify_query(self, query: List[bytes], sigma_b: G1Elem, purchaser_pk: G2Elem) -> bool:
 
-        
         #pairing
         e1=self.group.pair(sigma_b,self.g2)
 
         query_bytes = b''.join(query)
-        combined_input = query_bytes + self.public_key.export()
+        combined_input = query_bytes + purchaser_pk.export()
         combined_input_g1 = self.group.hashG1(combined_input)
         e2=self.group.pair(combined_input_g1,purchaser_pk)
 
-        # if e1 == e2:
-        #     print("require_response continues!")
-        # else:
-        #     print("require_response aborts!")
-
+        return e1 == e2
+
+
+    @profiled('verify_query')
+    def verify_queries(self, queries: List[Tuple[List[bytes], G1Elem, G2Elem]]) -> List[bool]:
+        """
+        Batch-verify (query, sigma_b, purchaser_pk) triples with a random linear
+        combination: e(sum r_i sigma_i, g2) == prod_pk e(sum_{pk_i = pk} r_i H_i, pk),
+        i.e. one pairing plus one per distinct purchaser key instead of two per query.
+        When the batch fails, every query is checked on its own to find the bad ones.
+        """
+        if len(queries) <= 1:
+            return [self.verify_query(*q) for q in queries]
+
+        sigma_sum = G1Elem.inf(self.group)
+        hash_sums = {}
+        for query, sigma_b, purchaser_pk in queries:
+            r = Bn.from_binary(os.urandom(BATCH_VERIFY_RANDOM_SIZE))
+            pk_bytes = purchaser_pk.export()
+            combined_input_g1 = self.group.hashG1(b''.join(query) + pk_bytes)
+
+            sigma_sum = sigma_sum.add(sigma_b.mul(r))
+            if pk_bytes in hash_sums:
+                hash_sum, _ = hash_sums[pk_bytes]
+                hash_sums[pk_bytes] = (hash_sum.add(combined_input_g1.mul(r)), purchaser_pk)
+            else:
+                hash_sums[pk_bytes] = (combined_input_g1.mul(r), purchaser_pk)
+
+        e1 = self.group.pair(sigma_sum, self.g2)
+        e2 = None
+        for hash_sum, purchaser_pk in hash_sums.values():
+            e = self.group.pair(hash_sum, purchaser_pk)
+            e2 = e if e2 is None else e2.mul(e)
+
+        if e1 == e2:
+            return [True] * len(queries)
+        return [self.verify_query(*q) for q in queries]
+
+
+    @profiled('require_response')
+    def require_response(self, secret: Bn, query: List[bytes], sigma_b: G1Elem, purchaser_pk: G2Elem, powers_table: bool = False, verify: bool = True) -> Tuple[List[Bn], Optional[List[List[G1Elem]]]]:
+        """
+        Blind the purchaser's query with the seller secret. The doubling table of every
+        reply point is only built and returned when powers_table is set; otherwise powers
+        is None and the purchaser unblinds each point with one scalar multiplication.
+        Raises ValueError if sigma_b does not verify or a query point does not decode;
+        pass verify=False when the query was already checked with verify_queries.
+        """
+        if verify and not self.verify_query(query, sigma_b, purchaser_pk):
+            raise ValueError("require_response aborts: invalid query signature")
 
         reply = list()
         max_power = self.ord
-        powers=[]
+        powers = [] if powers_table else None
         for kwd_h in query:
-            kwd_g1 = G1Elem.from_bytes(kwd_h, self.group)
+            #a signed query can still carry bytes that are not a point; bplib raises a bare Exception
+            try:
+                kwd_g1 = G1Elem.from_bytes(kwd_h, self.group)
+            except Exception as e:
+                raise ValueError("require_response aborts: invalid query point: {}".format(e))
             kwd_enc = kwd_g1.mul(secret)
             kwd_enc_bytes = kwd_enc.export()
             reply.append(kwd_enc_bytes)
 
+            if not powers_table:
+                continue
+
             power_row = []
             power_value=kwd_enc
 
@@ -205,4 +646,17 @@ class Seller:
             powers.append(power_row)
 
         # return reply
-        return reply,powers
\ No newline at end of file
+        return reply,powers
+
+
+    @profiled('require_response')
+    def require_response_many(self, secret: Bn, queries: List[Tuple[List[bytes], G1Elem, G2Elem]], powers_table: bool = False) -> List[Optional[Tuple[List[Bn], Optional[List[List[G1Elem]]]]]]:
+        """
+        Answer many queries after one batch signature check. Queries that fail
+        verification get None instead of a reply.
+        """
+        valid = self.verify_queries(queries)
+        return [
+            self.require_response(secret, query, sigma_b, purchaser_pk, powers_table, verify=False) if ok else None
+            for (query, sigma_b, purchaser_pk), ok in zip(queries, valid)
+        ]
\ No newline at end of file
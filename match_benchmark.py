@@ -6,106 +6,165 @@ import time
 import datetime
 import string
 import json
+import resource
+import argparse
 from bplib.bp import BpGroup, G1Elem, G2Elem
 from key import KeyManager
 
 sys.path.append('./')
 sys.path.append('..')
-from match import Purchaser,Seller
+from match import Purchaser,Seller,PublishedIndex,CuckooFilter
+from instrument import Profiler
+from wire import MSG_QUERY, MSG_REPLY, encode_points, encode_powers, encode_tags
 
 KEYWORD_LENGTH = 16
 DEFAULT_CURVE = 415
+SEED = 0
 
 DOCUMENT_NUMBER = [ int(10**(i / 3)) for i in range(3, 13)]
 DOCUMENT_ATTRIBUTE_NUMBER = (10000,)
 QUERY_ATTRIBUTE_NUMBER = (10000,)
+REPETITIONS = 1
+#ship the doubling table with every reply (the original protocol) instead of unblinding with secret^-1
+POWERS_TABLE = False
+
+#runs in seconds, for regression testing
+SMOKE_DOCUMENT_NUMBER = (10, 100)
+SMOKE_DOCUMENT_ATTRIBUTE_NUMBER = (10,)
+SMOKE_QUERY_ATTRIBUTE_NUMBER = (10,)
+SMOKE_REPETITIONS = 3
+
+
+def generate_kwds(rng, number_lists, number_kwds):
+    return [[''.join(rng.choice(string.ascii_lowercase) for _ in range(KEYWORD_LENGTH)) for _ in range(number_kwds)] for _ in range(number_lists)]
+
+
+def peak_rss():
+    #kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
 
 class BenchmarkMatch:
-    def __init__(self, data, number_docs_published, number_kwds_per_doc, number_kwds_per_query, repetitions=1, repetitions_publish=1):
-        random.seed(0)
+    def __init__(self, data, number_docs_published, number_kwds_per_doc, number_kwds_per_query, repetitions=REPETITIONS, repetitions_publish=1, powers_table=POWERS_TABLE, group=None, seed=SEED, cuckoo=False, workers=None, verbose=True, profiler=None):
+        rng = random.Random(seed)
 
         self.data = data
 
         self.repetitions = repetitions
         self.repetitions_publish = repetitions_publish
+        self.powers_table = powers_table
+        self.cuckoo = cuckoo
+        self.workers = workers
+        self.verbose = verbose
+        self.profiler = profiler
         self.number_docs_published = number_docs_published
         self.number_kwds_per_doc = number_kwds_per_doc
         self.number_kwds_per_query = number_kwds_per_query
 
-        self.kwds_published = [[(''.join((random.choice(string.ascii_lowercase) for _ in range(KEYWORD_LENGTH)))) for _ in range(number_kwds_per_doc)] for _ in range(number_docs_published)]
-        self.kwds_query = [[(''.join((random.choice(string.ascii_lowercase) for _ in range(KEYWORD_LENGTH)))) for _ in range(number_kwds_per_query)] for _ in range(repetitions)]
+        self.kwds_published = generate_kwds(rng, number_docs_published, number_kwds_per_doc)
+        self.kwds_query = generate_kwds(rng, repetitions, number_kwds_per_query)
 
-        self.group = BpGroup()
+        #the group precomputes generator multiples; share it across runs
+        self.group = group or BpGroup()
         self.g1 = self.group.gen1()
         self.g2 = self.group.gen2()
 
-        self.match_purchaser = Purchaser(self.number_docs_published,self.group,self.g1,self.g2)
-        self.match_seller = Seller(self.number_docs_published,self.group,self.g1,self.g2)
+        self.match_purchaser = Purchaser(self.number_docs_published,self.group,self.g1,self.g2, profiler=profiler)
+        self.match_seller = Seller(self.number_docs_published,self.group,self.g1,self.g2, profiler=profiler)
+
+    def record(self, op, times, walls, lengths, items):
+        entry = {
+            'time': times,
+            'wall': walls,
+            'length': lengths,
+            'throughput': [items / wall if wall else None for wall in walls],
+            'peak_rss': peak_rss(),
+        }
+        self.data[op].setdefault(self.number_docs_published, {}).setdefault(self.number_kwds_per_doc, {})[self.number_kwds_per_query] = entry
+        if self.verbose:
+            print(f"{op}: cpu {sum(times) / len(times)} s, wall {sum(walls) / len(walls)} s, {items * len(walls) / sum(walls) if sum(walls) else 0} items/s")
+        if self.profiler is not None:
+            #curve op breakdown of this phase only
+            entry['profile'] = self.profiler.stats()
+            if self.verbose:
+                print(self.profiler.report())
+            self.profiler.reset()
 
+    def run(self):
+        if self.profiler is not None:
+            self.profiler.reset()
 
+        times = []
+        walls = []
+        lengths = []
+        for _ in range(self.repetitions_publish):
+            c0, t0 = time.process_time(), time.perf_counter()
+            (secret_seller, issued,sigma_rec) = self.match_seller.attr_issue(self.kwds_published, cuckoo=self.cuckoo, workers=self.workers)
+            c1, t1 = time.process_time(), time.perf_counter()
+            times.append(c1 - c0)
+            walls.append(t1 - t0)
+            lengths.append(len(issued) if self.cuckoo else len(encode_tags(issued)))
 
-    def run(self):
-        t0 = time.process_time()
-        (secret_seller, issued,sigma_rec) = self.match_seller.attr_issue(self.kwds_published)
-        t1 = time.process_time()
-        attr_issue_time = t1 - t0
-        print(f"{attr_issue_time}")
+        #throughput in tags/s
+        self.record('publish', times, walls, lengths, self.number_docs_published * self.number_kwds_per_doc)
 
         times = []
+        walls = []
         lengths = []
         queries = []
         for kwds in self.kwds_query:
-            t0 = time.process_time()
+            c0, t0 = time.process_time(), time.perf_counter()
             query = self.match_purchaser.require_issue(kwds)
-            t1 = time.process_time()
-            require_issue_time = t1 - t0
-            print(f"{require_issue_time}")
-
-            times.append(t1-t0)
+            c1, t1 = time.process_time(), time.perf_counter()
 
-            length = sum(map(lambda x: len(x), query[1]))
-            lengths.append(length)
+            times.append(c1 - c0)
+            walls.append(t1 - t0)
+            lengths.append(len(encode_points(query[1], MSG_QUERY)))
 
             queries.append(query)
 
-        self.data['query'][self.number_docs_published][self.number_kwds_per_doc][self.number_kwds_per_query] = {'time': times, 'length': lengths}
+        #throughput in keywords/s
+        self.record('query', times, walls, lengths, self.number_kwds_per_query)
 
         times = []
+        walls = []
         lengths = []
         replies = []
         for query in queries:
-            t0 = time.process_time()
-            (reply,powers) = self.match_seller.require_response(secret_seller, query[1], query[2],query[3])
-            # (reply) = self.match_seller.require_response(secret_seller, query[1], query[2], query[3])
-            t1 = time.process_time()
-            require_response_time = t1 - t0
-            print(f"{require_response_time}")
+            c0, t0 = time.process_time(), time.perf_counter()
+            (reply,powers) = self.match_seller.require_response(secret_seller, query[1], query[2],query[3], powers_table=self.powers_table)
+            c1, t1 = time.process_time(), time.perf_counter()
 
-            length = sum(map(lambda x: len(x), reply))
-            length += sum(len(elem.export()) for row in powers for elem in row)
+            length = len(encode_points(reply, MSG_REPLY))
+            if powers is not None:
+                length += len(encode_powers(powers))
 
-            times.append(t1-t0)
+            times.append(c1 - c0)
+            walls.append(t1 - t0)
             lengths.append(length)
 
-            replies.append(reply)
+            replies.append((reply, powers))
 
-        self.data['reply'][self.number_docs_published][self.number_kwds_per_doc][self.number_kwds_per_query] = {'time': times, 'length': lengths}
+        self.record('reply', times, walls, lengths, self.number_kwds_per_query)
 
-        times = []
-        for i, reply in enumerate(replies):
-            t0 = time.process_time()
-            self.match_purchaser.attr_comfirm(queries[i][0], reply, issued, powers)
-            # self.match_purchaser.attr_comfirm(queries[i][0], reply, issued)
-            t1 = time.process_time()
-            attr_comfirm_time = t1 - t0
+        #the purchaser indexes the published tags once and reuses the index for every query
+        c0, t0 = time.process_time(), time.perf_counter()
+        published = CuckooFilter.from_bytes(issued) if self.cuckoo else PublishedIndex(issued)
+        c1, t1 = time.process_time(), time.perf_counter()
+        self.record('index', [c1 - c0], [t1 - t0], [], self.number_docs_published * self.number_kwds_per_doc)
 
-            print(f"{attr_comfirm_time} ")
-            print()
+        times = []
+        walls = []
+        for i, (reply, powers) in enumerate(replies):
+            #each reply is confirmed with its own powers table
+            c0, t0 = time.process_time(), time.perf_counter()
+            self.match_purchaser.attr_comfirm(queries[i][0], reply, published, powers)
+            c1, t1 = time.process_time(), time.perf_counter()
 
-            times.append(t1-t0)
+            times.append(c1 - c0)
+            walls.append(t1 - t0)
 
-        self.data['cardinality'][self.number_docs_published][self.number_kwds_per_doc][self.number_kwds_per_query] = {'time': times, 'length':[]}
+        self.record('cardinality', times, walls, [], self.number_kwds_per_query)
 
 
 def write_data(filename, data):
@@ -120,7 +179,11 @@ def write_data(filename, data):
                         'n_kwd_per_doc': p,
                         'n_kwd_per_query': q,
                         'times' : data[op][d][p][q]['time'],
-                        'lengths' : data[op][d][p][q]['length']
+                        'walls' : data[op][d][p][q]['wall'],
+                        'lengths' : data[op][d][p][q]['length'],
+                        'throughput' : data[op][d][p][q]['throughput'],
+                        'peak_rss' : data[op][d][p][q]['peak_rss'],
+                        'profile' : data[op][d][p][q].get('profile')
                     }
                     elem.append(times)
         structure[op] = elem
@@ -133,19 +196,37 @@ def write_data(filename, data):
 
 
 if __name__ == '__main__':
-    data = {'publish': {}, 'query': {}, 'reply': {}, 'cardinality': {}}
-
-    for n_docs_published in DOCUMENT_NUMBER:
-        for op in data.keys():
-            data[op][n_docs_published] = {}
-            for n_kwds_per_doc in DOCUMENT_ATTRIBUTE_NUMBER:
-                data[op][n_docs_published][n_kwds_per_doc] = {}
-
-    for n_docs_published in DOCUMENT_NUMBER:
-        for n_kwds_per_doc in DOCUMENT_ATTRIBUTE_NUMBER:
+    parser = argparse.ArgumentParser(description="Benchmark the PSI-cardinality publish/query/reply/confirm phases.")
+    parser.add_argument('--docs', type=int, nargs='+', default=DOCUMENT_NUMBER, help="number of published documents")
+    parser.add_argument('--kwds-per-doc', type=int, nargs='+', default=DOCUMENT_ATTRIBUTE_NUMBER)
+    parser.add_argument('--kwds-per-query', type=int, nargs='+', default=QUERY_ATTRIBUTE_NUMBER)
+    parser.add_argument('--repetitions', type=int, default=REPETITIONS, help="queries per configuration")
+    parser.add_argument('--repetitions-publish', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--powers-table', action='store_true', default=POWERS_TABLE)
+    parser.add_argument('--cuckoo', action='store_true', help="publish the tags as a cuckoo filter")
+    parser.add_argument('--workers', type=int, default=None, help="processes used by attr_issue")
+    parser.add_argument('--profile', action='store_true', help="count and time curve operations per protocol phase")
+    parser.add_argument('--smoke', action='store_true', help="small grid that runs in seconds")
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.smoke:
+        args.docs, args.kwds_per_doc, args.kwds_per_query, args.repetitions = SMOKE_DOCUMENT_NUMBER, SMOKE_DOCUMENT_ATTRIBUTE_NUMBER, SMOKE_QUERY_ATTRIBUTE_NUMBER, SMOKE_REPETITIONS
+
+    data = {'publish': {}, 'query': {}, 'reply': {}, 'index': {}, 'cardinality': {}}
+    group = BpGroup()
+    profiler = Profiler() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    for n_docs_published in args.docs:
+        for n_kwds_per_doc in args.kwds_per_doc:
             print("Benchmarking #docs = {}, #kwds_per_doc = {}".format(n_docs_published, n_kwds_per_doc))
-            for n_kwds_per_query in QUERY_ATTRIBUTE_NUMBER:
-                BenchmarkMatch(data, n_docs_published, n_kwds_per_doc, n_kwds_per_query).run()
+            for n_kwds_per_query in args.kwds_per_query:
+                BenchmarkMatch(data, n_docs_published, n_kwds_per_doc, n_kwds_per_query, args.repetitions, args.repetitions_publish,
+                               args.powers_table, group, args.seed, args.cuckoo, args.workers, not args.quiet, profiler).run()
 
     date = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%s')
-    write_data('benchmark-match-{}.json'.format(date), data)
+    write_data(args.output or 'benchmark-match-{}.json'.format(date), data)
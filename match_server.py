@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import string
+import struct
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+from bplib.bp import BpGroup, G1Elem, G2Elem
+
+sys.path.append('./')
+sys.path.append('..')
+from match import Purchaser, Seller, PublishedIndex, CuckooFilter
+from wire import MAGIC, MSG_QUERY, MSG_REPLY, encode_points, decode_points, encode_tags, PublishedTags
+
+FRAME_HEADER = struct.Struct(">IB")
+MAX_FRAME_SIZE = 1 << 30
+MAX_IN_FLIGHT_DEFAULT = 64
+
+OP_PUBLISHED = 1
+OP_QUERY = 2
+OP_REPLY = 3
+OP_ERROR = 4
+
+
+async def read_frame(reader:asyncio.StreamReader):
+    length, op = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame of {} bytes exceeds MAX_FRAME_SIZE".format(length))
+    payload = await reader.readexactly(length)
+    return op, payload
+
+
+async def write_frame(writer:asyncio.StreamWriter, op:int, payload:bytes):
+    writer.write(FRAME_HEADER.pack(len(payload), op) + payload)
+    #backpressure: wait until the transport buffer drains below its high-water mark
+    await writer.drain()
+
+
+def encode_request(query:List[bytes], sigma_b:G1Elem, purchaser_pk:G2Elem) -> bytes:
+    sigma_bytes = sigma_b.export()
+    pk_bytes = purchaser_pk.export()
+    return struct.pack(">BH", len(sigma_bytes), len(pk_bytes)) + sigma_bytes + pk_bytes + encode_points(query, MSG_QUERY)
+
+
+def decode_request(payload:bytes, group:BpGroup):
+    sigma_len, pk_len = struct.unpack_from(">BH", payload)
+    pos = 3
+    sigma_b = G1Elem.from_bytes(payload[pos:pos + sigma_len], group)
+    pos += sigma_len
+    purchaser_pk = G2Elem.from_bytes(payload[pos:pos + pk_len], group)
+    pos += pk_len
+    query = decode_points(payload[pos:], MSG_QUERY)
+    return query, sigma_b, purchaser_pk
+
+
+def decode_published(payload:bytes):
+    if payload[:len(MAGIC)] == MAGIC:
+        return PublishedIndex(PublishedTags(payload))
+    return CuckooFilter.from_bytes(payload)
+
+
+class SellerServer:
+    """
+    Asyncio service that hands out the published tags and answers purchaser queries.
+    The curve work of require_response runs in an executor; at most max_in_flight
+    responses are computed at once, and each connection is served one request at a
+    time so a slow reader only stalls itself.
+    """
+
+    def __init__(self, seller:Seller, secret, published, max_in_flight:int=MAX_IN_FLIGHT_DEFAULT, executor=None):
+        self.seller = seller
+        self.secret = secret
+        if isinstance(published, (bytes, bytearray)):
+            self.published = bytes(published)
+        else:
+            self.published = encode_tags(published)
+        self.max_in_flight = max_in_flight
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_in_flight)
+        self.n_queries = 0
+        self.n_rejected = 0
+        self._in_flight = None
+        self._server = None
+
+    async def start(self, host:str='127.0.0.1', port:int=0, path:Optional[str]=None):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    def _respond(self, payload:bytes) -> bytes:
+        #struct.error on a short payload, a bare bplib Exception on a bad point
+        try:
+            query, sigma_b, purchaser_pk = decode_request(payload, self.seller.group)
+        except Exception as e:
+            raise ValueError("Malformed query: {}".format(e))
+        reply, _ = self.seller.require_response(self.secret, query, sigma_b, purchaser_pk)
+        return encode_points(reply, MSG_REPLY)
+
+    async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    op, payload = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                if op == OP_PUBLISHED:
+                    await write_frame(writer, OP_PUBLISHED, self.published)
+                elif op == OP_QUERY:
+                    async with self._in_flight:
+                        try:
+                            response = await loop.run_in_executor(self.executor, self._respond, payload)
+                        except ValueError as e:
+                            self.n_rejected += 1
+                            await write_frame(writer, OP_ERROR, str(e).encode())
+                            continue
+                    self.n_queries += 1
+                    await write_frame(writer, OP_REPLY, response)
+                else:
+                    await write_frame(writer, OP_ERROR, "Unknown operation {}".format(op).encode())
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class PurchaserClient:
+    """
+    Async client for SellerServer. Fetches the published tags once and runs
+    require_issue / attr_comfirm around each remote require_response. The curve and
+    hash work runs on executor (the loop's default if None), so it does not block the
+    event loop.
+    """
+
+    def __init__(self, purchaser:Purchaser, executor=None):
+        self.purchaser = purchaser
+        self.executor = executor
+        self.published = None
+        self._reader = None
+        self._writer = None
+
+    async def connect(self, host:str='127.0.0.1', port:int=0, path:Optional[str]=None):
+        if path is not None:
+            self._reader, self._writer = await asyncio.open_unix_connection(path)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(host, port)
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    async def _call(self, op:int, payload:bytes) -> bytes:
+        await write_frame(self._writer, op, payload)
+        op, response = await read_frame(self._reader)
+        if op == OP_ERROR:
+            raise ValueError(response.decode())
+        return response
+
+    async def fetch_published(self):
+        payload = await self._call(OP_PUBLISHED, b'')
+        self.published = await asyncio.get_running_loop().run_in_executor(self.executor, decode_published, payload)
+        return self.published
+
+    async def query(self, kwds:List[str], top_k:Optional[int]=None):
+        if self.published is None:
+            await self.fetch_published()
+        loop = asyncio.get_running_loop()
+        secret, query_enc, sigma_b, public_key = await loop.run_in_executor(self.executor, self.purchaser.require_issue, kwds)
+        response = await self._call(OP_QUERY, encode_request(query_enc, sigma_b, public_key))
+        reply = decode_points(response, MSG_REPLY)
+        return await loop.run_in_executor(self.executor, lambda: self.purchaser.attr_comfirm(secret, reply, self.published, top_k=top_k))
+
+
+KEYWORD_LENGTH = 16
+NUMBER_DOCS = 100
+NUMBER_KWDS_PER_DOC = 100
+NUMBER_KWDS_PER_QUERY = 10
+CONCURRENT_PURCHASERS = 32
+QUERIES_PER_PURCHASER = 10
+SOCKET_PATH = '/tmp/crpps-seller.sock'
+
+
+def random_kwd():
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(KEYWORD_LENGTH))
+
+
+async def purchaser_sessions(path:str=SOCKET_PATH) -> float:
+    group = BpGroup()
+    g1, g2 = group.gen1(), group.gen2()
+
+    async def purchaser_session():
+        client = PurchaserClient(Purchaser(NUMBER_DOCS, group, g1, g2))
+        await client.connect(path=path)
+        for _ in range(QUERIES_PER_PURCHASER):
+            await client.query([random_kwd() for _ in range(NUMBER_KWDS_PER_QUERY)])
+        await client.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(purchaser_session() for _ in range(CONCURRENT_PURCHASERS)))
+    return time.perf_counter() - t0
+
+
+def run_purchasers(path:str=SOCKET_PATH) -> float:
+    return asyncio.run(purchaser_sessions(path))
+
+
+async def main():
+    random.seed(0)
+    group = BpGroup()
+    g1, g2 = group.gen1(), group.gen2()
+
+    docs = [[random_kwd() for _ in range(NUMBER_KWDS_PER_DOC)] for _ in range(NUMBER_DOCS)]
+    seller = Seller(NUMBER_DOCS, group, g1, g2)
+    secret, published, _ = seller.attr_issue(docs)
+
+    server = SellerServer(seller, secret, published)
+    await server.start(path=SOCKET_PATH)
+
+    #the purchasers run in their own process, so their curve work does not share this loop or the GIL with the seller
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as purchasers:
+        seconds = await asyncio.get_running_loop().run_in_executor(purchasers, run_purchasers, SOCKET_PATH)
+
+    await server.close()
+    print(f"{server.n_queries} queries from {CONCURRENT_PURCHASERS} purchasers in {seconds} seconds: {server.n_queries / seconds} queries/s")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
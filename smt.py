@@ -1,103 +1,539 @@
-from hash import sha256, get_binary_hash
+import os
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
+
+from smt_store import MemoryStore, VersionedStore
+from hash import sha256, get_binary_hash, leaf_hash, node_hash, hash_leaf_stream, HASH_VERSION_LEGACY, HASH_VERSION_BINARY, PATH_BITS, NODE_PREFIX
+
+#what update does with a leaf path that is already occupied
+COLLISION_SKIP = 'skip' #report it and keep the existing leaf
+COLLISION_RAISE = 'raise' #raise LeafCollisionError
+
+
+class LeafCollisionError(ValueError):
+    pass
+
+
+def to_path(bitmap, depth):
+    """
+    Leaf path of a '0'/'1' bitmap string, a 256-bit int path or a 32-byte digest,
+    truncated to its first depth bits.
+    """
+    if isinstance(bitmap, str):
+        return int(bitmap[:depth], 2)
+    if isinstance(bitmap, (bytes, bytearray)):
+        return int.from_bytes(bitmap, byteorder="big") >> (8 * len(bitmap) - depth)
+    return bitmap >> (PATH_BITS - depth)
+
+
+def hash_node(left_hash, right_hash, hash_version=HASH_VERSION_BINARY):
+    if hash_version == HASH_VERSION_LEGACY:
+        return sha256(str(left_hash + right_hash))
+    return node_hash(left_hash, right_hash)
+
+
+@lru_cache(maxsize=None)
+def get_default_hashes(depth, hash_version=HASH_VERSION_BINARY):
+    """
+    default_hashes[level] is the root of an empty subtree whose top is at that level.
+    The returned tuple is shared between trees and must not be modified.
+    The legacy tree used sha256('0') for an empty subtree at every level.
+    """
+    if hash_version == HASH_VERSION_LEGACY:
+        return (sha256('0'),) * (depth + 1)
+    default_hashes = [bytes(32)] * (depth + 1)
+    for level in reversed(range(depth)):
+        default_hashes[level] = hash_node(default_hashes[level + 1], default_hashes[level + 1], hash_version)
+    return tuple(default_hashes)
+
+
+class PayloadRef(namedtuple("PayloadRef", ["path", "offset", "length"])):
+    """
+    Reference to length bytes at offset of a file, kept in a leaf instead of the payload
+    itself. hash() gives the (leaf_hash, bitmap) of exactly those bytes to pass to update.
+    """
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(path, 0, os.path.getsize(path))
+
+    def open(self):
+        fd = open(self.path, 'rb')
+        fd.seek(self.offset)
+        return fd
+
+    def read(self):
+        with self.open() as fd:
+            return fd.read(self.length)
+
+    def hash(self):
+        with self.open() as fd:
+            return hash_leaf_stream(fd, length=self.length)
+
+
+#proof[level] is present for every level whose bit is set in bitmap, the rest are default hashes
+CompressedProof = namedtuple("CompressedProof", ["depth", "bitmap", "hashes"])
+
+#hashes for the siblings a multi-proof needs, in the order _multi_proof_siblings visits them
+MultiProof = namedtuple("MultiProof", ["depth", "bitmap", "hashes"])
+
+
+def compress_proof(proof, hash_version=HASH_VERSION_BINARY):
+    depth = len(proof)
+    default_hashes = get_default_hashes(depth, hash_version)
+    bitmap = 0
+    hashes = []
+    for level, sibling_hash in enumerate(proof):
+        if sibling_hash != default_hashes[level + 1]:
+            bitmap |= 1 << level
+            hashes.append(sibling_hash)
+    return CompressedProof(depth, bitmap, hashes)
+
+
+def decompress_proof(compressed, hash_version=HASH_VERSION_BINARY):
+    default_hashes = get_default_hashes(compressed.depth, hash_version)
+    hashes = iter(compressed.hashes)
+    return [next(hashes) if (compressed.bitmap >> level) & 1 else default_hashes[level + 1] for level in range(compressed.depth)]
+
+
+def _multi_proof_siblings(paths, depth):
+    """
+    Walk the union of the given leaf paths bottom-up and yield (level, prefix, known)
+    for every path node below the root, where known tells whether its sibling is itself
+    on one of the paths. Both proof generation and verification follow this order.
+    """
+    known = sorted(set(paths))
+    for level in reversed(range(1, depth + 1)):
+        known_set = set(known)
+        for prefix in known:
+            yield level, prefix, (prefix ^ 1) in known_set
+        known = sorted(set(prefix >> 1 for prefix in known))
+
+
+def verify_proof(root, leaf_hash, bitmap, proof, hash_version=HASH_VERSION_BINARY):
+    """
+    Check a root-to-leaf proof from get_proof, or its CompressedProof, by folding it
+    from the leaf up.
+    """
+    if isinstance(proof, CompressedProof):
+        proof = decompress_proof(proof, hash_version)
+    depth = len(proof)
+    path = to_path(bitmap, depth)
+    hash_value = leaf_hash
+    for level in reversed(range(depth)):
+        if (path >> (depth - level - 1)) & 1:
+            hash_value = hash_node(proof[level], hash_value, hash_version)
+        else:
+            hash_value = hash_node(hash_value, proof[level], hash_version)
+    return hash_value == root
+
+
+def _shared_levels(proof, default_hashes):
+    #number of levels above the lowest non-default sibling, found by bisection:
+    #the siblings below it are exactly the default hashes
+    low, high = 0, len(proof)
+    while low < high:
+        mid = (low + high) // 2
+        if tuple(proof[mid:]) == default_hashes[mid + 1:]:
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+
+def verify_many(root, items, hash_version=HASH_VERSION_BINARY):
+    """
+    Check a batch of (leaf_hash, bitmap, proof) items against one root. Returns one
+    bool per item. Upper nodes already reached by a verified proof are not hashed
+    again: a fold stops as soon as it meets one with the same hash. Below the lowest
+    non-default sibling of a proof the subtree holds only its leaf and cannot be
+    shared, so that part is folded without any lookup.
+    """
+    if hash_version == HASH_VERSION_BINARY:
+        node_prefix, new_sha256 = NODE_PREFIX, hashlib.sha256
+        node = lambda left_hash, right_hash: new_sha256(node_prefix + left_hash + right_hash).digest()
+    else:
+        node = lambda left_hash, right_hash: hash_node(left_hash, right_hash, hash_version)
+
+    verified = {}
+    results = []
+    for leaf_hash, bitmap, proof in items:
+        if isinstance(proof, CompressedProof):
+            depth = proof.depth
+            default_hashes = get_default_hashes(depth, hash_version)
+            #the highest set bit is the lowest non-default sibling
+            shared_levels = proof.bitmap.bit_length()
+            hashes = iter(proof.hashes)
+            proof = [next(hashes) if (proof.bitmap >> level) & 1 else default_hashes[level + 1] for level in range(shared_levels)]
+        else:
+            depth = len(proof)
+            default_hashes = get_default_hashes(depth, hash_version)
+            shared_levels = _shared_levels(proof, default_hashes)
+        bits = format(to_path(bitmap, depth), '0{}b'.format(depth))
+
+        hash_value = leaf_hash
+        for bit, default_hash in zip(reversed(bits[shared_levels:]), reversed(default_hashes[shared_levels + 1:])):
+            if bit == '1':
+                hash_value = node(default_hash, hash_value)
+            else:
+                hash_value = node(hash_value, default_hash)
+
+        computed = []
+        ok = None
+        for level in range(shared_levels - 1, -1, -1):
+            if bits[level] == '1':
+                hash_value = node(proof[level], hash_value)
+            else:
+                hash_value = node(hash_value, proof[level])
+            key = (level, bits[:level])
+            if key in verified:
+                ok = verified[key] == hash_value
+                break
+            computed.append((key, hash_value))
+        if ok is None:
+            ok = hash_value == root
+        if ok:
+            verified.update(computed)
+        results.append(ok)
+    return results
+
+
+def verify_multi_proof(root, items, multi_proof, hash_version=HASH_VERSION_BINARY):
+    """
+    Check (leaf_hash, bitmap) items against one root with a MultiProof from
+    SparseMerkleTree.get_multi_proof. Absent keys are checked with the empty leaf hash.
+    """
+    depth = multi_proof.depth
+    default_hashes = get_default_hashes(depth, hash_version)
+    values = {}
+    for leaf_hash, bitmap in items:
+        key = (depth, to_path(bitmap, depth))
+        if values.setdefault(key, leaf_hash) != leaf_hash:
+            return False
+
+    hashes = iter(multi_proof.hashes)
+    index = 0
+    for level, prefix, known in _multi_proof_siblings([path for _, path in values], depth):
+        if known:
+            if prefix & 1:
+                #the parent was hashed from the left sibling
+                continue
+            sibling_hash = values[(level, prefix ^ 1)]
+        elif (multi_proof.bitmap >> index) & 1:
+            sibling_hash = next(hashes, None)
+            if sibling_hash is None:
+                return False
+            index += 1
+        else:
+            sibling_hash = default_hashes[level]
+            index += 1
+
+        own_hash = values[(level, prefix)]
+        if prefix & 1:
+            values[(level - 1, prefix >> 1)] = hash_node(sibling_hash, own_hash, hash_version)
+        else:
+            values[(level - 1, prefix >> 1)] = hash_node(own_hash, sibling_hash, hash_version)
+
+    return values.get((0, 0)) == root
 
-class SparseMerkleTreeNode:
-    def __init__(self, hash_value, parent = None, left = None, right = None, data = None):
-        self.hash_value = hash_value
-        self.parent = parent
-        self.left = left
-        self.right = right
-        self.data = data
 
 class SparseMerkleTree:
-    def __init__(self, depth):
+    """
+    Sparse Merkle tree keyed by (level, prefix).
+
+    Only non-empty subtrees are stored. A subtree holding a single leaf is stored
+    once, at its topmost node, together with the path of that leaf; everything below
+    it is implied by the leaf and the per-level default hashes. Nodes stored with
+    leaf path None have at least two leaves below them.
+
+    hash_version selects the node hashing from hash.py; HASH_VERSION_LEGACY keeps the
+    original int digests and flat sha256('0') empty hash, so it reproduces the roots of
+    the original tree.
+
+    Nodes, leaf hashes and payloads are kept in store, a MemoryStore by default or
+    a smt_store.SqliteStore for a persistent tree.
+
+    collision is COLLISION_SKIP or COLLISION_RAISE, for inserts into an occupied leaf.
+    """
+
+    def __init__(self, depth, hash_version=HASH_VERSION_BINARY, store=None, collision=COLLISION_SKIP):
         self.depth = depth
+        self.hash_version = hash_version
+        self.collision = collision
         self.empty_hash = self.get_empty_hash()
-        self.root = SparseMerkleTreeNode(self.empty_hash)
-    
+        self.default_hashes = self._get_default_hashes()
+        #(level, prefix) -> (hash_value, leaf path or None), leaf path -> (leaf_hash, data)
+        self.store = store if store is not None else MemoryStore()
+        self.store.open(depth, hash_version)
+
     def get_empty_hash(self):
 
+        if self.hash_version == HASH_VERSION_BINARY:
+            return bytes(32)
         empty_hash = sha256('0')
         return empty_hash
-    
+
+    def _get_default_hashes(self):
+        return get_default_hashes(self.depth, self.hash_version)
+
+    def _hash_node(self, left_hash, right_hash):
+        return hash_node(left_hash, right_hash, self.hash_version)
+
+    def _path(self, bitmap):
+        return to_path(bitmap, self.depth)
+
+    def _prefix(self, path, level):
+        return path >> (self.depth - level)
+
+    def _bit(self, path, level):
+        #branch taken below the node at this level
+        return (path >> (self.depth - level - 1)) & 1
+
+    def _get_hash(self, level, prefix):
+        node = self.store.get_node(level, prefix)
+        return self.default_hashes[level] if node is None else node[0]
+
+    def _fold(self, path, to_level):
+        #hash of the single-leaf subtree rooted at to_level on the way to path
+        hash_value = self.store.get_leaf_hash(path)
+        for level in reversed(range(to_level, self.depth)):
+            if self._bit(path, level):
+                hash_value = self._hash_node(self.default_hashes[level + 1], hash_value)
+            else:
+                hash_value = self._hash_node(hash_value, self.default_hashes[level + 1])
+        return hash_value
+
     def update(self, data, leaf_hash, bitmap):
-        self._update_tree(self.root, leaf_hash, bitmap, 0, data)
-        proof = self.get_proof(self.root, bitmap)
+        """
+        Insert data under bitmap with its precomputed leaf_hash. data may be a PayloadRef
+        so that large payloads stay out of the tree.
+        """
+        path = self._path(bitmap)
+        dirty = set()
+        self._insert(path, leaf_hash, data, dirty)
+        self._update_hash(dirty)
+        self.store.commit()
+        proof = self.get_proof(bitmap)
         return proof
-    
-    def _update_tree(self, node, leaf_hash, bitmap, level, data):
-        if level == self.depth:
-            if node.hash_value != self.empty_hash:
-                print("The location already has data stored. Please renegotiate.")
-                return
-            node.hash_value = leaf_hash
-            node.data = data
-            self._update_hash(node)
-            return
-
-        if bitmap[level] == '0':
-            if node.left == None:
-                node.left = SparseMerkleTreeNode(self.empty_hash, node)
-            self._update_tree(node.left, leaf_hash, bitmap, level + 1, data)
-        else:
-            if node.right == None:
-                node.right = SparseMerkleTreeNode(self.empty_hash, node)
-            self._update_tree(node.right, leaf_hash, bitmap, level + 1, data)
 
-    def _update_hash(self, node):
-        current_node = node
+    def update_many(self, items, proofs=False):
+        """
+        Insert many (data, leaf_hash, bitmap) items, then rehash every touched node
+        exactly once, bottom-up. Returns the per-leaf proofs when proofs is set;
+        otherwise they can be requested later with get_proof.
+        """
+        items = list(items)
+        dirty = set()
+        try:
+            for data, leaf_hash, bitmap in items:
+                self._insert(self._path(bitmap), leaf_hash, data, dirty)
+        finally:
+            #on a LeafCollisionError the items before it stay inserted
+            self._update_hash(dirty)
+            self.store.commit()
+        if proofs:
+            return [self.get_proof(bitmap) for _, _, bitmap in items]
+
+    def _insert(self, path, leaf_hash, data, dirty):
+        if self.store.get_leaf_hash(path) is not None:
+            if self.collision == COLLISION_RAISE:
+                raise LeafCollisionError("Leaf {:x} already has data stored".format(path))
+            print("The location already has data stored. Please renegotiate.")
+            return False
+        self.store.put_leaf(path, leaf_hash, data)
+
+        level = 0
+        while True:
+            key = (level, self._prefix(path, level))
+            node = self.store.get_node(*key)
+            dirty.add(key)
 
-        while current_node.parent is not None:
-            parent_node = current_node.parent
+            if node is None:
+                self.store.put_node(*key, (None, path))
+                return True
 
-            left_hash = parent_node.left.hash_value if parent_node.left else self.empty_hash
-            right_hash = parent_node.right.hash_value if parent_node.right else self.empty_hash
-            parent_node.hash_value = sha256(str(left_hash + right_hash))
+            if node[1] is None:
+                level += 1
+                continue
 
-            current_node = parent_node
-    
-    def get_proof(self, root, bitmap):
+            #split a single-leaf subtree: both leaves share every node down to the first differing bit
+            other = node[1]
+            split_level = self.depth - (path ^ other).bit_length()
+            for shared_level in range(level, split_level + 1):
+                shared_key = (shared_level, self._prefix(path, shared_level))
+                self.store.put_node(*shared_key, (None, None))
+                dirty.add(shared_key)
+            for leaf_path in (path, other):
+                leaf_key = (split_level + 1, self._prefix(leaf_path, split_level + 1))
+                self.store.put_node(*leaf_key, (None, leaf_path))
+                dirty.add(leaf_key)
+            return True
+
+    def _update_hash(self, dirty):
+        #children before parents
+        for key in sorted(dirty, key=lambda key: key[0], reverse=True):
+            level, prefix = key
+            leaf_path = self.store.get_node(level, prefix)[1]
+            if leaf_path is not None:
+                hash_value = self._fold(leaf_path, level)
+            else:
+                hash_value = self._hash_node(self._get_hash(level + 1, prefix << 1), self._get_hash(level + 1, (prefix << 1) | 1))
+            self.store.put_node(level, prefix, (hash_value, leaf_path))
+
+    def get_proof(self, bitmap):
+        """
+        Sibling hashes from the root down to the leaf: proof[level] is the sibling of the
+        path node at level + 1.
+        """
+        path = self._path(bitmap)
         proof = []
-        current_node = root
-        
-        for level in range(self.depth):
-            if bitmap[level] == '0':
-                if current_node.right:
-                    proof.append(current_node.right.hash_value)
-                else:
-                    proof.append(self.empty_hash)
-                current_node = current_node.left
+
+        node = self.store.get_node(0, 0)
+        while len(proof) < self.depth and node is not None and node[1] is None:
+            level = len(proof)
+            child_prefix = self._prefix(path, level + 1)
+            proof.append(self._get_hash(level + 1, child_prefix ^ 1))
+            node = self.store.get_node(level + 1, child_prefix)
+
+        #below an empty or single-leaf subtree every sibling is a default hash,
+        #except where the path of a different leaf branches off
+        split_level = None
+        if node is not None and node[1] != path:
+            split_level = self.depth - (path ^ node[1]).bit_length()
+        for level in range(len(proof), self.depth):
+            if level == split_level:
+                proof.append(self._fold(node[1], level + 1))
             else:
-                if current_node.left:
-                    proof.append(current_node.left.hash_value)
-                else:
-                    proof.append(self.empty_hash)
-                current_node = current_node.right
-        
+                proof.append(self.default_hashes[level + 1])
+
         return proof
 
+    def get_compressed_proof(self, bitmap):
+        return compress_proof(self.get_proof(bitmap), self.hash_version)
+
+    def _get_subtree_hash(self, level, prefix):
+        #hash of any node, including the unstored ones inside a single-leaf subtree
+        node = self.store.get_node(level, prefix)
+        if node is not None:
+            return node[0]
+        for top_level in reversed(range(level)):
+            top = self.store.get_node(top_level, prefix >> (level - top_level))
+            if top is None:
+                continue
+            if top[1] is not None and self._prefix(top[1], level) == prefix:
+                return self._fold(top[1], level)
+            break
+        return self.default_hashes[level]
+
+    def get_multi_proof(self, bitmaps):
+        """
+        One proof for several keys: sibling hashes shared by their paths are sent once,
+        siblings that lie on another requested path are not sent at all, and default
+        siblings are only flagged in the bitmap.
+        """
+        paths = [self._path(bitmap) for bitmap in bitmaps]
+        bitmap = 0
+        hashes = []
+        index = 0
+        for level, prefix, known in _multi_proof_siblings(paths, self.depth):
+            if known:
+                continue
+            sibling_hash = self._get_subtree_hash(level, prefix ^ 1)
+            if sibling_hash != self.default_hashes[level]:
+                bitmap |= 1 << index
+                hashes.append(sibling_hash)
+            index += 1
+        return MultiProof(self.depth, bitmap, hashes)
+
     def get_root(self):
-        return self.root.hash_value
-    
+        return self._get_hash(0, 0)
+
     def get_data(self, bitmap):
-        current_node = self.root
-        for level in range(self.depth):
-            if bitmap[level] == '0':
-                current_node = current_node.left
-            else:
-                current_node = current_node.right
-        
-        return current_node.data
- 
+        return self.store.get_data(self._path(bitmap))
+
+    def get_payload(self, bitmap):
+        """
+        Like get_data, but loads the payload a PayloadRef leaf points to.
+        """
+        data = self.get_data(bitmap)
+        return data.read() if isinstance(data, PayloadRef) else data
+
+    def close(self):
+        self.store.close()
+
+class VersionedSparseMerkleTree(SparseMerkleTree):
+    """
+    Persistent SparseMerkleTree: every update or update_many creates a new version that
+    shares all untouched nodes with the previous one, so roots, proofs and data of
+    earlier versions stay available. Only the last keep_versions versions are kept
+    when it is set.
+    """
+
+    def __init__(self, depth, hash_version=HASH_VERSION_BINARY, keep_versions=None, collision=COLLISION_SKIP):
+        super().__init__(depth, hash_version, VersionedStore(), collision)
+        self.keep_versions = keep_versions
+        self.roots = {0: self.default_hashes[0]}
+
+    @property
+    def version(self):
+        return self.store.version
+
+    def _commit_version(self):
+        version = self.store.version
+        self.roots[version] = super().get_root()
+        if self.keep_versions is not None and version >= self.keep_versions:
+            min_version = version - self.keep_versions + 1
+            self.store.prune(min_version)
+            for old_version in [v for v in self.roots if v < min_version]:
+                del self.roots[old_version]
+        return version
+
+    def update(self, data, leaf_hash, bitmap):
+        self.store.begin_version()
+        try:
+            proof = super().update(data, leaf_hash, bitmap)
+        finally:
+            self._commit_version()
+        return proof
+
+    def update_many(self, items, proofs=False):
+        self.store.begin_version()
+        try:
+            result = super().update_many(items, proofs)
+        finally:
+            self._commit_version()
+        return result
+
+    def snapshot(self, version):
+        """
+        Read-only SparseMerkleTree of an earlier version.
+        """
+        if version not in self.roots:
+            raise ValueError("Version {} was pruned or does not exist".format(version))
+        return SparseMerkleTree(self.depth, self.hash_version, self.store.at(version), self.collision)
+
+    def get_root(self, version=None):
+        if version is None:
+            return super().get_root()
+        return self.snapshot(version).get_root()
+
+    def get_proof(self, bitmap, version=None):
+        if version is None:
+            return super().get_proof(bitmap)
+        return self.snapshot(version).get_proof(bitmap)
+
+    def get_data(self, bitmap, version=None):
+        if version is None:
+            return super().get_data(bitmap)
+        return self.snapshot(version).get_data(bitmap)
+
 if __name__ == "__main__":
     smt = SparseMerkleTree(256)
 
-    hash = sha256("data1")
-    proof = smt.update(["data1","test"], hash, get_binary_hash("key"))
-    res = sha256("data1")
-    for i in range(len(proof)):
-        res = sha256(str(res+proof[i]))
-    print(res)
-    print(smt.get_root())
-    print(smt.get_data(get_binary_hash("key")))
-
-    
\ No newline at end of file
+    hash = leaf_hash("data1")
+    bitmap = get_binary_hash("key", HASH_VERSION_BINARY)
+    proof = smt.update(["data1","test"], hash, bitmap)
+    print(verify_proof(smt.get_root(), leaf_hash("data1"), bitmap, proof))
+    print(smt.get_root().hex())
+    print(smt.get_data(bitmap))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import json
+import random
+import argparse
+import datetime
+import tracemalloc
+
+sys.path.append('./')
+sys.path.append('..')
+from smt import SparseMerkleTree, verify_proof, verify_many, to_path
+from hash import leaf_hash, hash_leaf_stream, get_binary_hash, HASH_VERSION_BINARY
+
+TREE_SIZES = [10**i for i in range(0, 7)]
+TREE_DEPTHS = (32, 64, 256)
+PAYLOAD_SIZES = (4 * 1024, 256 * 1024, 4 * 1024 * 1024)
+REPETITIONS = 20
+WARMUP = 2
+#proofs of pre-filled leaves added to the verify_loop / verify_many batch
+VERIFY_BATCH = 500
+PERCENTILES = (50, 90, 99)
+
+SMOKE_TREE_SIZES = (1, 100)
+SMOKE_TREE_DEPTHS = (32, 256)
+SMOKE_PAYLOAD_SIZES = (4 * 1024,)
+SMOKE_REPETITIONS = 3
+
+HASH_SIZE = 32
+
+
+def percentiles(times):
+    ordered = sorted(times)
+    return {p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in PERCENTILES}
+
+
+def generate_payload(size):
+    return random.randbytes(size)
+
+
+class BenchmarkSMT:
+    def __init__(self, data, n_leaves, depth, payload_size, repetitions=REPETITIONS, warmup=WARMUP, memory=True):
+        random.seed(0)
+
+        self.data = data
+        self.n_leaves = n_leaves
+        self.depth = depth
+        self.payload_size = payload_size
+        self.repetitions = repetitions
+        self.warmup = warmup
+        self.memory = memory
+
+        #leaves of the pre-filled tree share one payload, only their keys differ
+        self.payload = generate_payload(payload_size)
+        #keys whose truncated paths collide are dropped, so the timed build never hits a collision
+        self.items = []
+        paths = set()
+        for i in range(n_leaves):
+            bitmap = get_binary_hash(str(i), HASH_VERSION_BINARY)
+            path = to_path(bitmap, depth)
+            if path not in paths:
+                paths.add(path)
+                self.items.append((self.payload, leaf_hash(str(i)), bitmap))
+        self.new_payloads = [generate_payload(payload_size) for _ in range(warmup + repetitions)]
+
+    def record(self, op, times, lengths=(), peak_memory=None):
+        self.data.setdefault(op, {}).setdefault(self.n_leaves, {}).setdefault(self.depth, {})[self.payload_size] = {
+            'time': times,
+            'length': list(lengths),
+            'percentiles': percentiles(times),
+            'peak_memory': peak_memory,
+        }
+
+    def measure(self, fn, args):
+        times = []
+        results = []
+        for i, arg in enumerate(args):
+            t0 = time.perf_counter()
+            result = fn(arg)
+            t1 = time.perf_counter()
+            if i >= self.warmup:
+                times.append(t1 - t0)
+                results.append(result)
+        return times, results
+
+    def build(self):
+        tree = SparseMerkleTree(self.depth)
+        tree.update_many(self.items)
+        return tree
+
+    def run(self):
+        build_reps = max(1, min(self.repetitions, 10**6 // max(self.n_leaves, 1)))
+        times, _ = self.measure(lambda _: self.build(), range(self.warmup + build_reps))
+        peak_memory = None
+        if self.memory:
+            tracemalloc.start()
+            tree = self.build()
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            tree = self.build()
+        self.record('batch_insert', times, peak_memory=peak_memory)
+        print(f"batch_insert #leaves = {self.n_leaves}: {percentiles(times)} s, peak memory {peak_memory} B")
+
+        def insert(payload):
+            hash_value, bitmap = hash_leaf_stream(payload)
+            return tree.update(payload, hash_value, bitmap), hash_value, bitmap
+
+        times, inserted = self.measure(insert, self.new_payloads)
+        self.record('insert', times)
+        print(f"insert: {percentiles(times)} s")
+
+        bitmaps = [bitmap for _, _, bitmap in inserted]
+        lookups = bitmaps[:self.warmup] + bitmaps if self.warmup <= len(bitmaps) else bitmaps
+
+        times, proofs = self.measure(tree.get_proof, lookups)
+        self.record('proof', times, [len(proof) * HASH_SIZE for proof in proofs])
+        print(f"proof: {percentiles(times)} s")
+
+        times, compressed = self.measure(tree.get_compressed_proof, lookups)
+        self.record('compressed_proof', times, [len(proof.hashes) * HASH_SIZE + (self.depth + 7) // 8 for proof in compressed])
+        print(f"compressed_proof: {percentiles(times)} s")
+
+        times, _ = self.measure(tree.get_data, lookups)
+        self.record('get_data', times)
+        print(f"get_data: {percentiles(times)} s")
+
+        root = tree.get_root()
+        #proofs returned by update are stale once later leaves are inserted
+        checks = [(hash_value, bitmap, proof) for (_, hash_value, bitmap), proof in zip(inserted, proofs)]
+        times, valid = self.measure(lambda check: verify_proof(root, *check), checks[:self.warmup] + checks)
+        assert all(valid)
+        self.record('verify', times)
+        print(f"verify: {percentiles(times)} s")
+
+        #the same batch through a plain loop and through verify_many, per proof
+        batch = checks + [(hash_value, bitmap, tree.get_proof(bitmap)) for _, hash_value, bitmap in self.items[:VERIFY_BATCH]]
+        times, valid = self.measure(lambda _: [verify_proof(root, *check) for check in batch], range(self.warmup + self.repetitions))
+        assert all(all(v) for v in valid)
+        self.record('verify_loop', [t / len(batch) for t in times])
+        print(f"verify_loop (per proof): {percentiles(times)[50] / len(batch)} s")
+
+        times, valid = self.measure(lambda _: verify_many(root, batch), range(self.warmup + self.repetitions))
+        assert all(all(v) for v in valid)
+        self.record('verify_many', [t / len(batch) for t in times])
+        print(f"verify_many (per proof): {percentiles(times)[50] / len(batch)} s")
+
+
+def write_data(filename, data):
+    structure = {}
+    for op in data.keys():
+        elem = []
+        for n in data[op].keys():
+            for d in data[op][n].keys():
+                for s in data[op][n][d].keys():
+                    times = {
+                        'n_leaves': n,
+                        'depth': d,
+                        'payload_size': s,
+                        'times': data[op][n][d][s]['time'],
+                        'lengths': data[op][n][d][s]['length'],
+                        'percentiles': data[op][n][d][s]['percentiles'],
+                        'peak_memory': data[op][n][d][s]['peak_memory'],
+                    }
+                    elem.append(times)
+        structure[op] = elem
+
+    content = json.dumps(structure)
+
+    with open(filename, 'w') as fd:
+        fd.write(content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the SparseMerkleTree send/receive/verify flow.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=TREE_SIZES, help="number of leaves in the tree")
+    parser.add_argument('--depths', type=int, nargs='+', default=TREE_DEPTHS)
+    parser.add_argument('--payloads', type=int, nargs='+', default=PAYLOAD_SIZES, help="payload sizes in bytes")
+    parser.add_argument('--repetitions', type=int, default=REPETITIONS)
+    parser.add_argument('--warmup', type=int, default=WARMUP)
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced build used for peak memory")
+    parser.add_argument('--smoke', action='store_true', help="small grid that runs in seconds")
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.smoke:
+        args.sizes, args.depths, args.payloads, args.repetitions = SMOKE_TREE_SIZES, SMOKE_TREE_DEPTHS, SMOKE_PAYLOAD_SIZES, SMOKE_REPETITIONS
+
+    data = {}
+    for n_leaves in args.sizes:
+        for depth in args.depths:
+            for payload_size in args.payloads:
+                print("Benchmarking #leaves = {}, depth = {}, payload = {} B".format(n_leaves, depth, payload_size))
+                BenchmarkSMT(data, n_leaves, depth, payload_size, args.repetitions, args.warmup, not args.no_memory).run()
+
+    date = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%s')
+    write_data(args.output or 'benchmark-smt-{}.json'.format(date), data)
@@ -0,0 +1,141 @@
+from collections import namedtuple
+from typing import Optional
+
+from hash import leaf_hash, get_binary_hash, HASH_VERSION_BINARY
+from smt import VersionedSparseMerkleTree, LeafCollisionError, COLLISION_RAISE, to_path, verify_proof
+
+MAILBOX_DEPTH = 256
+#Mailbox collision policies; COLLISION_RAISE comes from smt
+COLLISION_PROBE = 'probe'
+MAX_PROBES = 16
+
+
+def mailbox_address(message_key:bytes) -> str:
+    return "addr" + message_key.hex()
+
+
+def _leaf_hash(data) -> bytes:
+    #only bytes-like and str data have a defined encoding to hash
+    if not isinstance(data, (bytes, bytearray, memoryview, str)):
+        raise TypeError("hash_value is required for {} data".format(type(data).__name__))
+    return leaf_hash(data)
+
+
+def slot_bitmap(address:str, probe:int=0) -> int:
+    #probe 0 is the address itself, probe i > 0 re-hashes it with a counter
+    return get_binary_hash(address if probe == 0 else "{}#{}".format(address, probe), HASH_VERSION_BINARY)
+
+
+class Delivery(namedtuple("Delivery", ["data", "proof", "root", "epoch", "bitmap"])):
+    """
+    One mailbox slot as fetched by its recipient: the posted data, its proof against the
+    root published for epoch, and the leaf bitmap the proof is for.
+    """
+
+    __slots__ = ()
+
+    def verify(self, hash_value:Optional[bytes]=None) -> bool:
+        #hash_value defaults to leaf_hash(data) and is required for data other than bytes or str, as in Mailbox.post
+        return verify_proof(self.root, _leaf_hash(self.data) if hash_value is None else hash_value, self.bitmap, self.proof)
+
+
+class Mailbox:
+    """
+    Mailbox of ratchet-addressed deliveries on a VersionedSparseMerkleTree.
+
+    Any number of senders post(address, data) into the current epoch; publish() inserts
+    all of the epoch's posts with one update_many and returns (epoch, root), every epoch
+    being one version of the tree. Addresses are indexed to their epoch and leaf bitmap,
+    so fetch finds a slot without re-deriving it and returns data, proof and root in one
+    call. Only the last keep_epochs epochs can be fetched when it is set; this bounds the
+    history of interior nodes, not the deliveries themselves, which stay in the tree and
+    the address index for good.
+
+    Two addresses can land on the same leaf, since a leaf keeps only depth bits of the
+    address hash. With collision=COLLISION_RAISE the later post raises LeafCollisionError;
+    with COLLISION_PROBE it moves on to slot_bitmap(address, 1), (address, 2), ... up to
+    MAX_PROBES. Posting the same address twice always raises ValueError.
+    """
+
+    def __init__(self, depth:int=MAILBOX_DEPTH, collision:str=COLLISION_RAISE, keep_epochs:Optional[int]=None):
+        self.tree = VersionedSparseMerkleTree(depth, HASH_VERSION_BINARY, keep_epochs, COLLISION_RAISE)
+        self.collision = collision
+        #address -> (epoch published or None while pending, bitmap)
+        self._index = {}
+        self._pending = []
+        self._pending_paths = set()
+
+    @property
+    def epoch(self) -> int:
+        #last published epoch; 0 is the empty mailbox
+        return self.tree.version
+
+    def _occupied(self, path) -> bool:
+        return path in self._pending_paths or self.tree.store.get_leaf_hash(path) is not None
+
+    def post(self, address:str, data, hash_value:Optional[bytes]=None) -> int:
+        """
+        Queue data under address for the next publish and return its leaf bitmap.
+        hash_value is the leaf hash, leaf_hash(data) by default; it is required when data
+        is not bytes or str (e.g. the [nonce, ciphertext] list trade.py posts), and the
+        recipient must pass the same hash_value to Delivery.verify.
+        """
+        if address in self._index:
+            raise ValueError("Address {} was already posted".format(address))
+        if hash_value is None:
+            hash_value = _leaf_hash(data)
+
+        n_probes = MAX_PROBES if self.collision == COLLISION_PROBE else 1
+        for probe in range(n_probes):
+            bitmap = slot_bitmap(address, probe)
+            path = to_path(bitmap, self.tree.depth)
+            if not self._occupied(path):
+                break
+        else:
+            raise LeafCollisionError("No free leaf for address {} after {} probes".format(address, n_probes))
+
+        self._pending_paths.add(path)
+        self._index[address] = (None, bitmap)
+        self._pending.append((address, data, hash_value, bitmap))
+        return bitmap
+
+    def publish(self):
+        """
+        Insert every pending post as a new epoch and return (epoch, root).
+        """
+        self.tree.update_many((data, hash_value, bitmap) for _, data, hash_value, bitmap in self._pending)
+        epoch = self.tree.version
+        for address, _, _, bitmap in self._pending:
+            self._index[address] = (epoch, bitmap)
+        self._pending = []
+        self._pending_paths = set()
+        return epoch, self.tree.roots[epoch]
+
+    def root(self, epoch:Optional[int]=None):
+        return self.tree.roots[self.epoch if epoch is None else epoch]
+
+    def get_data(self, address:str, epoch:Optional[int]=None):
+        entry = self._index.get(address)
+        if entry is None or entry[0] is None:
+            return None
+        published, bitmap = entry
+        if epoch is not None and epoch < published:
+            return None
+        return self.tree.get_data(bitmap, None if epoch is None or epoch == self.epoch else epoch)
+
+    def fetch(self, address:str, epoch:Optional[int]=None, compressed:bool=False) -> Optional[Delivery]:
+        """
+        Delivery of address as of epoch, the latest by default, or None if it was not
+        published by then. compressed returns a CompressedProof.
+        """
+        entry = self._index.get(address)
+        if entry is None or entry[0] is None:
+            return None
+        published, bitmap = entry
+        epoch = self.epoch if epoch is None else epoch
+        if epoch < published:
+            return None
+
+        tree = self.tree if epoch == self.epoch else self.tree.snapshot(epoch)
+        proof = tree.get_compressed_proof(bitmap) if compressed else tree.get_proof(bitmap)
+        return Delivery(tree.get_data(bitmap), proof, self.tree.roots[epoch], epoch, bitmap)
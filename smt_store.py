@@ -0,0 +1,279 @@
+import pickle
+import sqlite3
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from operator import itemgetter
+
+from hash import HASH_VERSION_BINARY
+
+NODE_CACHE_SIZE = 100000
+
+
+class MemoryStore:
+    """
+    Node store of a SparseMerkleTree held in dicts.
+    Nodes are (hash_value, leaf path or None) keyed by (level, prefix); leaves keep
+    their hash and their payload.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.leaves = {}
+
+    def open(self, depth, hash_version):
+        pass
+
+    def get_node(self, level, prefix):
+        return self.nodes.get((level, prefix))
+
+    def put_node(self, level, prefix, node):
+        self.nodes[(level, prefix)] = node
+
+    def get_leaf_hash(self, path):
+        leaf = self.leaves.get(path)
+        return None if leaf is None else leaf[0]
+
+    def put_leaf(self, path, leaf_hash, data):
+        self.leaves[path] = (leaf_hash, data)
+
+    def get_data(self, path):
+        leaf = self.leaves.get(path)
+        return None if leaf is None else leaf[1]
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    """
+    Disk-backed node store in a local sqlite database.
+
+    Leaf payloads live in their own table and are only read by get_data, so the
+    node and leaf-hash tables stay small. Opening an existing tree reads nothing but
+    its parameters; nodes are loaded on demand through an LRU cache of node_cache_size
+    entries, which also remembers absent nodes.
+    """
+
+    def __init__(self, path, node_cache_size=NODE_CACHE_SIZE):
+        self.path = path
+        self.node_cache_size = node_cache_size
+        self._cache = OrderedDict()
+        #nodes waiting for their hash; never evicted
+        self._pending = {}
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS nodes (level INTEGER, prefix BLOB, hash BLOB, leaf BLOB, PRIMARY KEY (level, prefix)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS leaves (path BLOB PRIMARY KEY, hash BLOB) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS payloads (path BLOB PRIMARY KEY, data BLOB);
+        """)
+
+    def open(self, depth, hash_version):
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        if meta and (meta['depth'], meta['hash_version']) != (depth, hash_version):
+            raise ValueError("{} holds a tree of depth {} and hash version {}".format(self.path, meta['depth'], meta['hash_version']))
+        self.db.executemany("INSERT OR IGNORE INTO meta VALUES (?, ?)", (('depth', depth), ('hash_version', hash_version)))
+        self.db.commit()
+        self.depth = depth
+        self.hash_version = hash_version
+        self._key_size = (depth + 7) // 8
+
+    def _encode_key(self, value):
+        return value.to_bytes(self._key_size, byteorder="big")
+
+    def _encode_hash(self, hash_value):
+        if self.hash_version == HASH_VERSION_BINARY:
+            return hash_value
+        return hash_value.to_bytes(32, byteorder="big")
+
+    def _decode_hash(self, hash_bytes):
+        if self.hash_version == HASH_VERSION_BINARY:
+            return hash_bytes
+        return int.from_bytes(hash_bytes, byteorder="big")
+
+    def _cache_get(self, key):
+        value = self._cache.get(key, self)
+        if value is not self:
+            self._cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.node_cache_size:
+            self._cache.popitem(last=False)
+
+    def get_node(self, level, prefix):
+        key = (level, prefix)
+        node = self._pending.get(key)
+        if node is not None:
+            return node
+        node = self._cache_get(key)
+        if node is not self:
+            return node
+
+        node = None
+        row = self.db.execute("SELECT hash, leaf FROM nodes WHERE level = ? AND prefix = ?", (level, self._encode_key(prefix))).fetchone()
+        if row is not None:
+            hash_bytes, leaf = row
+            node = (self._decode_hash(hash_bytes), None if leaf is None else int.from_bytes(leaf, byteorder="big"))
+        self._cache_put(key, node)
+        return node
+
+    def put_node(self, level, prefix, node):
+        hash_value, leaf_path = node
+        if hash_value is None:
+            #placeholder until the tree rehashes it before commit
+            self._pending[(level, prefix)] = node
+            return
+        self._pending.pop((level, prefix), None)
+        self._cache_put((level, prefix), node)
+        self.db.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)", (
+            level, self._encode_key(prefix), self._encode_hash(hash_value),
+            None if leaf_path is None else self._encode_key(leaf_path)
+        ))
+
+    def get_leaf_hash(self, path):
+        key = ('leaf', path)
+        leaf_hash = self._cache_get(key)
+        if leaf_hash is not self:
+            return leaf_hash
+
+        row = self.db.execute("SELECT hash FROM leaves WHERE path = ?", (self._encode_key(path),)).fetchone()
+        leaf_hash = None if row is None else self._decode_hash(row[0])
+        self._cache_put(key, leaf_hash)
+        return leaf_hash
+
+    def put_leaf(self, path, leaf_hash, data):
+        self._cache_put(('leaf', path), leaf_hash)
+        self.db.execute("INSERT INTO leaves VALUES (?, ?)", (self._encode_key(path), self._encode_hash(leaf_hash)))
+        self.db.execute("INSERT INTO payloads VALUES (?, ?)", (self._encode_key(path), pickle.dumps(data)))
+
+    def get_data(self, path):
+        row = self.db.execute("SELECT data FROM payloads WHERE path = ?", (self._encode_key(path),)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class VersionedStore:
+    """
+    Copy-on-write node store keeping the history of every node.
+
+    Each node key maps to a list of (version, node) entries. Writes during the current
+    version replace its own entry and otherwise append, so a version costs memory in
+    proportion to the paths it touched. at(version) gives a read-only view of an
+    earlier version, and prune(min_version) drops entries no longer visible from any
+    version >= min_version.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.history = {}
+        #leaf path -> (version added, leaf_hash, data)
+        self.leaves = {}
+        #(version, key) for every entry that was superseded at that version
+        self._superseded = deque()
+
+    def open(self, depth, hash_version):
+        pass
+
+    def begin_version(self):
+        self.version += 1
+        return self.version
+
+    def _get(self, key, version):
+        entries = self.history.get(key)
+        if not entries:
+            return None
+        i = bisect_right(entries, version, key=itemgetter(0))
+        return entries[i - 1][1] if i else None
+
+    def get_node(self, level, prefix):
+        return self._get((level, prefix), self.version)
+
+    def put_node(self, level, prefix, node):
+        key = (level, prefix)
+        entries = self.history.setdefault(key, [])
+        if entries and entries[-1][0] == self.version:
+            entries[-1] = (self.version, node)
+            return
+        if entries:
+            self._superseded.append((self.version, key))
+        entries.append((self.version, node))
+
+    def get_leaf_hash(self, path, version=None):
+        leaf = self.leaves.get(path)
+        if leaf is None or leaf[0] > (self.version if version is None else version):
+            return None
+        return leaf[1]
+
+    def put_leaf(self, path, leaf_hash, data):
+        self.leaves[path] = (self.version, leaf_hash, data)
+
+    def get_data(self, path, version=None):
+        leaf = self.leaves.get(path)
+        if leaf is None or leaf[0] > (self.version if version is None else version):
+            return None
+        return leaf[2]
+
+    def at(self, version):
+        if version > self.version:
+            raise ValueError("Version {} does not exist yet".format(version))
+        return VersionView(self, version)
+
+    def prune(self, min_version):
+        while self._superseded and self._superseded[0][0] <= min_version:
+            _, key = self._superseded.popleft()
+            entries = self.history[key]
+            #keep the newest entry visible at min_version and everything after it
+            i = bisect_right(entries, min_version, key=itemgetter(0))
+            if i > 1:
+                del entries[:i - 1]
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VersionView:
+    """
+    Read-only view of a VersionedStore as it was at one version.
+    """
+
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+
+    def open(self, depth, hash_version):
+        pass
+
+    def get_node(self, level, prefix):
+        return self.store._get((level, prefix), self.version)
+
+    def get_leaf_hash(self, path):
+        return self.store.get_leaf_hash(path, self.version)
+
+    def get_data(self, path):
+        return self.store.get_data(path, self.version)
+
+    def put_node(self, level, prefix, node):
+        raise ValueError("Version {} is read-only".format(self.version))
+
+    def put_leaf(self, path, leaf_hash, data):
+        raise ValueError("Version {} is read-only".format(self.version))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+from hash import leaf_hash, get_binary_hash, hash_leaf_stream, HASH_VERSION_BINARY
+
+DATA = bytes(range(256)) * 40
+
+
+def expected(data):
+    return leaf_hash(data), get_binary_hash(data, HASH_VERSION_BINARY)
+
+
+@pytest.mark.parametrize("chunk_size", (7, 1 << 20))
+def test_hash_leaf_stream_sources(chunk_size):
+    assert hash_leaf_stream(DATA, chunk_size) == expected(DATA)
+    assert hash_leaf_stream(memoryview(DATA), chunk_size) == expected(DATA)
+    assert hash_leaf_stream(io.BytesIO(DATA), chunk_size) == expected(DATA)
+    text = "payload é" * 100
+    assert hash_leaf_stream(text, chunk_size) == expected(text)
+
+
+@pytest.mark.parametrize("chunk_size", (7, 1 << 20))
+def test_hash_leaf_stream_length(chunk_size):
+    fd = io.BytesIO(DATA)
+    fd.seek(100)
+    assert hash_leaf_stream(fd, chunk_size, length=1000) == expected(DATA[100:1100])
+    assert fd.tell() == 1100
+    assert hash_leaf_stream(DATA, chunk_size, length=10) == expected(DATA[:10])
+    assert hash_leaf_stream(io.BytesIO(DATA), chunk_size, length=0) == expected(b'')
+
+    with pytest.raises(ValueError):
+        hash_leaf_stream(io.BytesIO(DATA[:50]), chunk_size, length=51)
+    with pytest.raises(ValueError):
+        hash_leaf_stream(DATA[:50], chunk_size, length=51)
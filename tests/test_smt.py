@@ -0,0 +1,197 @@
+import random
+
+import pytest
+
+from hash import sha256, leaf_hash, get_binary_hash, HASH_VERSION_LEGACY, HASH_VERSION_BINARY
+from smt import (SparseMerkleTree, PayloadRef, VersionedSparseMerkleTree, LeafCollisionError, COLLISION_RAISE, to_path, hash_node,
+                 verify_proof, verify_many, verify_multi_proof, compress_proof, decompress_proof, CompressedProof)
+
+DEPTH = 8
+HASH_VERSIONS = (HASH_VERSION_LEGACY, HASH_VERSION_BINARY)
+
+
+def make_items(n, hash_version=HASH_VERSION_BINARY, depth=DEPTH, seed=0):
+    """
+    (data, leaf_hash, bitmap) items with distinct paths at depth.
+    """
+    rng = random.Random(seed)
+    items = []
+    paths = set()
+    while len(items) < n:
+        data = str(rng.getrandbits(64))
+        bitmap = get_binary_hash(data, hash_version)
+        path = to_path(bitmap, depth)
+        if path in paths:
+            continue
+        paths.add(path)
+        items.append((data, leaf_hash(data) if hash_version == HASH_VERSION_BINARY else sha256(data), bitmap))
+    return items
+
+
+def naive_levels(items, hash_version=HASH_VERSION_BINARY, depth=DEPTH):
+    """
+    Every node of the full tree: levels[level][prefix]. A legacy empty subtree hashes
+    to sha256('0') at every level, as in the original tree.
+    """
+    empty_hash = bytes(32) if hash_version == HASH_VERSION_BINARY else sha256('0')
+    leaves = [empty_hash] * (1 << depth)
+    filled = [False] * (1 << depth)
+    for _, hash_value, bitmap in items:
+        leaves[to_path(bitmap, depth)] = hash_value
+        filled[to_path(bitmap, depth)] = True
+    levels = [leaves]
+    while len(levels[0]) > 1:
+        below = levels[0]
+        filled = [filled[i] or filled[i + 1] for i in range(0, len(filled), 2)]
+        levels.insert(0, [
+            hash_node(below[2 * i], below[2 * i + 1], hash_version) if filled[i] or hash_version == HASH_VERSION_BINARY else empty_hash
+            for i in range(len(filled))
+        ])
+    return levels
+
+
+def naive_proof(levels, bitmap, depth=DEPTH):
+    path = to_path(bitmap, depth)
+    return [levels[level + 1][(path >> (depth - level - 1)) ^ 1] for level in range(depth)]
+
+
+@pytest.mark.parametrize("hash_version", HASH_VERSIONS)
+def test_matches_naive_tree(hash_version):
+    items = make_items(60, hash_version)
+    absent = make_items(80, hash_version)[60:]
+    tree = SparseMerkleTree(DEPTH, hash_version)
+
+    #single inserts, then a batch on top of them
+    for i, (data, hash_value, bitmap) in enumerate(items[:20]):
+        tree.update(data, hash_value, bitmap)
+        assert tree.get_root() == naive_levels(items[:i + 1], hash_version)[0][0]
+    tree.update_many(items[20:])
+
+    levels = naive_levels(items, hash_version)
+    assert tree.get_root() == levels[0][0]
+    for data, hash_value, bitmap in items:
+        proof = tree.get_proof(bitmap)
+        assert proof == naive_proof(levels, bitmap)
+        assert verify_proof(tree.get_root(), hash_value, bitmap, proof, hash_version)
+        assert tree.get_data(bitmap) == data
+    for _, _, bitmap in absent:
+        assert tree.get_proof(bitmap) == naive_proof(levels, bitmap)
+        assert tree.get_data(bitmap) is None
+
+
+def test_legacy_root_matches_original_tree():
+    #the original tree folded a lone leaf with the flat empty hash on every level
+    hash_value = sha256("data1")
+    tree = SparseMerkleTree(256, HASH_VERSION_LEGACY)
+    tree.update(["data1", "test"], hash_value, get_binary_hash("key"))
+    for _ in range(256):
+        hash_value = sha256(str(hash_value + sha256('0')))
+    assert tree.get_root() == hash_value
+    assert SparseMerkleTree(256, HASH_VERSION_LEGACY).get_root() == sha256('0')
+
+
+def test_empty_tree_root():
+    assert SparseMerkleTree(DEPTH).get_root() == naive_levels([])[0][0]
+
+
+def test_compressed_proofs():
+    items = make_items(30)
+    tree = SparseMerkleTree(DEPTH)
+    tree.update_many(items)
+    root = tree.get_root()
+
+    for _, hash_value, bitmap in items:
+        proof = tree.get_proof(bitmap)
+        compressed = tree.get_compressed_proof(bitmap)
+        assert isinstance(compressed, CompressedProof)
+        assert compressed == compress_proof(proof)
+        assert decompress_proof(compressed) == proof
+        assert verify_proof(root, hash_value, bitmap, compressed)
+        assert not verify_proof(root, leaf_hash("other"), bitmap, compressed)
+
+    checks = [(hash_value, bitmap, tree.get_compressed_proof(bitmap)) for _, hash_value, bitmap in items]
+    checks.append((leaf_hash("other"), items[0][2], checks[0][2]))
+    assert verify_many(root, checks) == [True] * len(items) + [False]
+
+
+def test_multi_proofs():
+    items = make_items(40)
+    absent = make_items(50)[40:]
+    tree = SparseMerkleTree(DEPTH)
+    tree.update_many(items)
+    root = tree.get_root()
+
+    rng = random.Random(1)
+    for n in (1, 2, 5, 20):
+        chosen = rng.sample(items, n)
+        queries = [(hash_value, bitmap) for _, hash_value, bitmap in chosen] + [(bytes(32), bitmap) for _, _, bitmap in absent[:n]]
+        multi_proof = tree.get_multi_proof([bitmap for _, bitmap in queries])
+        assert verify_multi_proof(root, queries, multi_proof)
+
+        tampered = [(leaf_hash("other"), queries[0][1])] + queries[1:]
+        assert not verify_multi_proof(root, tampered, multi_proof)
+
+
+def test_collision_raise():
+    items = make_items(3)
+    tree = SparseMerkleTree(DEPTH, collision=COLLISION_RAISE)
+    tree.update_many(items)
+    with pytest.raises(LeafCollisionError):
+        tree.update("again", leaf_hash("again"), items[0][2])
+    assert tree.get_root() == naive_levels(items)[0][0]
+
+
+def test_versioned_snapshots():
+    items = make_items(50)
+    tree = VersionedSparseMerkleTree(DEPTH)
+    versions = {0: []}
+    for i in range(0, len(items), 10):
+        tree.update_many(items[i:i + 10])
+        versions[tree.version] = items[:i + 10]
+
+    for version, inserted in versions.items():
+        levels = naive_levels(inserted)
+        assert tree.get_root(version) == levels[0][0]
+        assert tree.roots[version] == levels[0][0]
+        for data, hash_value, bitmap in items:
+            proof = tree.get_proof(bitmap, version)
+            assert proof == naive_proof(levels, bitmap)
+            present = (data, hash_value, bitmap) in inserted
+            assert tree.get_data(bitmap, version) == (data if present else None)
+            if present:
+                assert verify_proof(levels[0][0], hash_value, bitmap, proof)
+
+
+def test_versioned_pruning():
+    items = make_items(60)
+    tree = VersionedSparseMerkleTree(DEPTH, keep_versions=2)
+    for data, hash_value, bitmap in items:
+        tree.update(data, hash_value, bitmap)
+
+    assert sorted(tree.roots) == [len(items) - 1, len(items)]
+    for version in (0, len(items) - 2):
+        with pytest.raises(ValueError):
+            tree.snapshot(version)
+    for version in (len(items) - 1, len(items)):
+        levels = naive_levels(items[:version])
+        snapshot = tree.snapshot(version)
+        assert snapshot.get_root() == levels[0][0]
+        for _, _, bitmap in items:
+            assert snapshot.get_proof(bitmap) == naive_proof(levels, bitmap)
+
+
+def test_payload_ref(tmp_path):
+    path = tmp_path / "payloads"
+    data = bytes(range(256)) * 10
+    path.write_bytes(data)
+
+    ref = PayloadRef(str(path), 300, 1000)
+    assert ref.read() == data[300:1300]
+    hash_value, bitmap = ref.hash()
+    assert (hash_value, bitmap) == (leaf_hash(data[300:1300]), get_binary_hash(data[300:1300], HASH_VERSION_BINARY))
+
+    tree = SparseMerkleTree(DEPTH)
+    tree.update(ref, hash_value, bitmap)
+    assert tree.get_payload(bitmap) == data[300:1300]
+    assert verify_proof(tree.get_root(), leaf_hash(tree.get_payload(bitmap)), bitmap, tree.get_proof(bitmap))
+    assert PayloadRef.from_file(str(path)).hash() == (leaf_hash(data), get_binary_hash(data, HASH_VERSION_BINARY))
@@ -0,0 +1,122 @@
+import pytest
+
+from hash import leaf_hash
+from smt import LeafCollisionError, CompressedProof, to_path
+from smt_mailbox import Mailbox, Delivery, COLLISION_PROBE, MAX_PROBES, mailbox_address, slot_bitmap
+
+DEPTH = 8
+
+
+def colliding_addresses(depth=DEPTH):
+    #two addresses whose first slot is the same leaf
+    seen = {}
+    for i in range(1 << 16):
+        address = mailbox_address(i.to_bytes(4, 'big'))
+        path = to_path(slot_bitmap(address), depth)
+        if path in seen:
+            return seen[path], address
+        seen[path] = address
+
+
+def test_post_publish_fetch():
+    mailbox = Mailbox(DEPTH)
+    addresses = [mailbox_address(bytes([i]) * 32) for i in range(2)]
+    mailbox.post(addresses[0], b'first')
+    mailbox.post(addresses[1], "second")
+    assert mailbox.fetch(addresses[0]) is None
+
+    epoch, root = mailbox.publish()
+    assert (epoch, root) == (1, mailbox.root())
+    for address, data in zip(addresses, (b'first', "second")):
+        delivery = mailbox.fetch(address)
+        assert isinstance(delivery, Delivery)
+        assert (delivery.data, delivery.root, delivery.epoch) == (data, root, epoch)
+        assert delivery.verify()
+        assert mailbox.get_data(address) == data
+
+    compressed = mailbox.fetch(addresses[0], compressed=True)
+    assert isinstance(compressed.proof, CompressedProof)
+    assert compressed.verify()
+    assert not compressed.verify(leaf_hash(b'other'))
+    assert mailbox.fetch(mailbox_address(b'unknown')) is None
+
+
+def test_fetch_by_epoch():
+    mailbox = Mailbox(DEPTH)
+    first, second = mailbox_address(b'\x01'), mailbox_address(b'\x02')
+    mailbox.post(first, b'first')
+    epoch1, root1 = mailbox.publish()
+    mailbox.post(second, b'second')
+    epoch2, root2 = mailbox.publish()
+    assert root1 != root2
+
+    assert mailbox.fetch(second, epoch1) is None
+    assert mailbox.get_data(second, epoch1) is None
+    old = mailbox.fetch(first, epoch1)
+    assert (old.root, old.epoch) == (root1, epoch1)
+    assert old.verify()
+    assert mailbox.fetch(first).root == root2
+    assert mailbox.fetch(first).verify()
+
+
+def test_keep_epochs():
+    mailbox = Mailbox(DEPTH, keep_epochs=2)
+    addresses = [mailbox_address(bytes([i])) for i in range(4)]
+    for address in addresses:
+        mailbox.post(address, address)
+        mailbox.publish()
+
+    with pytest.raises(ValueError):
+        mailbox.fetch(addresses[0], 1)
+    #deliveries of pruned epochs are still in the latest tree
+    assert mailbox.fetch(addresses[0]).verify()
+    assert mailbox.fetch(addresses[2], 3).verify()
+
+
+def test_collision_raise():
+    first, second = colliding_addresses()
+    mailbox = Mailbox(DEPTH)
+    mailbox.post(first, b'first')
+    with pytest.raises(LeafCollisionError):
+        mailbox.post(second, b'second')
+    mailbox.publish()
+    with pytest.raises(LeafCollisionError):
+        mailbox.post(second, b'second')
+
+
+def test_collision_probe():
+    first, second = colliding_addresses()
+    mailbox = Mailbox(DEPTH, collision=COLLISION_PROBE)
+    mailbox.post(first, b'first')
+    bitmap = mailbox.post(second, b'second')
+    assert to_path(bitmap, DEPTH) != to_path(slot_bitmap(first), DEPTH)
+    assert bitmap in [slot_bitmap(second, probe) for probe in range(1, MAX_PROBES)]
+
+    mailbox.publish()
+    for address, data in ((first, b'first'), (second, b'second')):
+        delivery = mailbox.fetch(address)
+        assert delivery.data == data
+        assert delivery.verify()
+
+
+def test_post_twice():
+    mailbox = Mailbox(DEPTH)
+    address = mailbox_address(b'\x01')
+    mailbox.post(address, b'first')
+    with pytest.raises(ValueError):
+        mailbox.post(address, b'again')
+
+
+def test_structured_data_needs_hash_value():
+    mailbox = Mailbox(DEPTH)
+    address = mailbox_address(b'\x01')
+    data = [b'nonce', b'ciphertext']
+    with pytest.raises(TypeError):
+        mailbox.post(address, data)
+
+    mailbox.post(address, data, leaf_hash(data[1]))
+    mailbox.publish()
+    delivery = mailbox.fetch(address)
+    with pytest.raises(TypeError):
+        delivery.verify()
+    assert delivery.verify(leaf_hash(delivery.data[1]))
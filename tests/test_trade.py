@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from trade import DoubleRatchet, generate_parameters, generate_key_pair, generate_shared_key
+
+
+def make_ratchets(**kwargs):
+    group, g1, g2 = generate_parameters()
+    seller_private_key, seller_public_key = generate_key_pair(group, g2)
+    buyer_private_key, buyer_public_key = generate_key_pair(group, g2)
+    seller = DoubleRatchet(generate_shared_key(seller_private_key, buyer_public_key), group, g1, g2)
+    buyer = DoubleRatchet(generate_shared_key(buyer_private_key, seller_public_key), group, g1, g2, **kwargs)
+    return seller, buyer
+
+
+def dh_step(seller, buyer):
+    _, seller_dh_pub = seller.ratcher_send_key(buyer.dh_public_key)
+    buyer.ratcher_recv_key(seller_dh_pub)
+
+
+def test_recv_message_out_of_order():
+    seller, buyer = make_ratchets()
+    sent = [seller.send_message(str(i)) for i in range(20)]
+    dh_step(seller, buyer)
+    sent += [seller.send_message(str(i)) for i in range(20, 40)]
+
+    order = list(range(40))
+    random.Random(0).shuffle(order)
+    for i in order:
+        assert buyer.recv_message(*sent[i]) == str(i)
+    with pytest.raises(ValueError):
+        buyer.recv_message(*sent[0])
+
+
+def test_recv_messages_across_epochs():
+    seller, buyer = make_ratchets()
+    first = [seller.send_message(str(i)) for i in range(600)]
+    dh_step(seller, buyer)
+    second = [seller.send_message(str(i)) for i in range(600, 1200)]
+
+    assert buyer.recv_messages(first + second) == [str(i) for i in range(1200)]
+    with pytest.raises(ValueError):
+        buyer.recv_message(*first[0])
+
+
+def test_recv_messages_beyond_skipped_key_bound():
+    seller, buyer = make_ratchets(max_skipped_keys=2)
+    sent = [seller.send_message(str(i)) for i in range(5)]
+
+    assert buyer.recv_messages(sent) == ['0', '1', '2', '3', '4']
+
+
+def test_recv_messages_keeps_gaps():
+    seller, buyer = make_ratchets()
+    sent = [seller.send_message(str(i)) for i in range(10)]
+
+    assert buyer.recv_messages(sent[::2] + sent[:1]) == ['0', '2', '4', '6', '8', None]
+    assert buyer.recv_messages(sent[1::2]) == ['1', '3', '5', '7', '9']
@@ -0,0 +1,120 @@
+from hashlib import blake2b
+
+import pytest
+
+from bplib.bp import BpGroup
+from match import CuckooFilter, PublishedIndex, kwd_encode, DOC_ID_SIZE
+from wire import (HEADER, MSG_QUERY, MSG_REPLY, MSG_TAGS, TAG_RECORD_SIZE, encode_points, decode_points, read_header,
+                  encode_powers, decode_powers, encode_tags, write_tags, PublishedTags)
+
+POINTS = [bytes([i]) * 33 for i in range(5)] + [b'', b'\x07' * 65]
+
+
+def make_tags(n_docs=20, n_kwds=5):
+    return [(doc_id, kwd_encode(doc_id.to_bytes(DOC_ID_SIZE, byteorder="big"), str(i).encode())) for doc_id in range(n_docs) for i in range(n_kwds)]
+
+
+def test_points_round_trip():
+    assert decode_points(encode_points(POINTS, MSG_QUERY), MSG_QUERY) == POINTS
+    assert decode_points(encode_points(POINTS, MSG_REPLY), MSG_REPLY) == POINTS
+    assert decode_points(encode_points([], MSG_QUERY), MSG_QUERY) == []
+
+
+def test_points_rejects_malformed():
+    buf = encode_points(POINTS, MSG_QUERY)
+    with pytest.raises(ValueError):
+        decode_points(buf, MSG_REPLY)
+    with pytest.raises(ValueError):
+        decode_points(b'XXXX' + buf[4:], MSG_QUERY)
+    #every truncation, including inside the header and inside the last point
+    for end in range(len(buf)):
+        with pytest.raises(ValueError):
+            decode_points(buf[:end], MSG_QUERY)
+    with pytest.raises(ValueError):
+        decode_points(buf + b'\x00', MSG_QUERY)
+
+
+def test_read_header():
+    assert read_header(encode_points(POINTS, MSG_QUERY), MSG_QUERY) == len(POINTS)
+    with pytest.raises(ValueError):
+        read_header(b'\x01', MSG_QUERY)
+
+
+def test_powers_round_trip():
+    group = BpGroup()
+    g1 = group.gen1()
+    powers = [[g1.mul(i + 1), g1.mul(i + 2)] for i in range(3)]
+    buf = encode_powers(powers)
+    assert decode_powers(buf, group) == powers
+    with pytest.raises(ValueError):
+        decode_powers(buf[:-1], group)
+    with pytest.raises(ValueError):
+        decode_powers(buf + b'\x00', group)
+    with pytest.raises(ValueError):
+        decode_powers(buf[:HEADER.size + 1], group)
+
+
+def test_tags_round_trip(tmp_path):
+    tags = make_tags()
+    buf = encode_tags(tags)
+    assert len(buf) == HEADER.size + len(tags) * TAG_RECORD_SIZE
+
+    view = PublishedTags(buf)
+    assert len(view) == len(tags)
+    assert [(doc_id, bytes(tag)) for doc_id, tag in view] == tags
+    assert (view[3][0], bytes(view[3][1])) == tags[3]
+    with pytest.raises(IndexError):
+        view[len(tags)]
+
+    index = PublishedIndex(view)
+    assert index.n_docs == 20
+    assert all(tag in index for _, tag in tags)
+    assert blake2b(b'absent').digest() not in index
+
+    raw = PublishedTags(buf[HEADER.size:], raw=True)
+    assert [(doc_id, bytes(tag)) for doc_id, tag in raw] == tags
+
+    path = str(tmp_path / "tags")
+    write_tags(path, tags)
+    with PublishedTags.open(path) as mapped:
+        assert [(doc_id, bytes(tag)) for doc_id, tag in mapped] == tags
+
+
+def test_tags_rejects_malformed():
+    buf = encode_tags(make_tags())
+    for bad in (buf[:-1], buf + b'\x00', buf[:HEADER.size - 1], encode_points(POINTS, MSG_QUERY)):
+        with pytest.raises(ValueError):
+            PublishedTags(bad)
+    with pytest.raises(ValueError):
+        PublishedTags(buf[HEADER.size:-1], raw=True)
+    assert read_header(buf, MSG_TAGS) == 100
+
+
+def test_cuckoo_filter():
+    tags = [tag for _, tag in make_tags(100, 10)]
+    tag_filter = CuckooFilter.from_tags(tags)
+    assert len(tag_filter) == len(tags)
+    assert all(tag in tag_filter for tag in tags)
+    absent = [blake2b(str(i).encode()).digest() for i in range(2000)]
+    #false positives are possible, but rare with the default fingerprint size
+    assert sum(tag in tag_filter for tag in absent) < 20
+
+    restored = CuckooFilter.from_bytes(tag_filter.to_bytes())
+    assert (restored.n_buckets, restored.bucket_size, restored.fingerprint_size, len(restored)) == (tag_filter.n_buckets, tag_filter.bucket_size, tag_filter.fingerprint_size, len(tag_filter))
+    assert restored.table == tag_filter.table
+    assert all(tag in restored for tag in tags)
+
+
+def test_cuckoo_filter_full():
+    tag_filter = CuckooFilter(8, bucket_size=2)
+    tags = [blake2b(str(i).encode()).digest() for i in range(64)]
+    inserted = [tag for tag in tags if tag_filter.insert(tag)]
+    assert len(inserted) == len(tag_filter) <= 8
+    assert all(tag in tag_filter for tag in inserted)
+
+
+def test_cuckoo_filter_rejects_malformed():
+    data = CuckooFilter.from_tags([tag for _, tag in make_tags()]).to_bytes()
+    for bad in (data[:-1], data + b'\x00', data[:CuckooFilter.HEADER.size - 1]):
+        with pytest.raises(ValueError):
+            CuckooFilter.from_bytes(bad)
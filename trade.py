@@ -1,4 +1,9 @@
 import os
+import hmac
+import hashlib
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
@@ -8,9 +13,25 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.kdf.concatkdf import ConcatKDFHash
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 import bplib.bp as bp
-from hash import sha256, get_binary_hash
-import smt
+from hash import leaf_hash
+from smt_mailbox import Mailbox, mailbox_address
+
+NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+#batches at least this large are encrypted/decrypted on a thread pool; AESGCM releases the GIL
+PARALLEL_AEAD_MIN_BYTES = 1 << 20
+#(epoch, message number) of counted messages, bound into their associated data
+MESSAGE_HEADER = struct.Struct(">II")
+#skipped message keys kept for out-of-order messages; oldest evicted first
+MAX_SKIPPED_KEYS = 1000
+#most message keys a single receive may derive ahead
+MAX_SKIP = 1000
+#receiving chains kept after the DH ratchet moves on
+MAX_RECV_CHAINS = 4
+
+_aead_executor = None
 
 def generate_parameters():
     group = bp.BpGroup()
@@ -49,9 +70,65 @@ def decrypt_message(key, nonce, ciphertext, associated_data=b''):
     plaintext = aesgcm.decrypt(nonce, ciphertext, associated_data)
     return plaintext.decode()
 
+def kdf_chain(chain_key):
+    """
+    One step of the symmetric ratchet: (next chain key, message key).
+    """
+    next_chain_key = hmac.new(chain_key, b'\x02', hashlib.sha256).digest()
+    message_key = hmac.new(chain_key, b'\x01', hashlib.sha256).digest()
+    return next_chain_key, message_key
+
+def _cached_aead(cached, key):
+    #(chain key, AESGCM) reused until the chain key changes
+    if cached is None or cached[0] != key:
+        cached = (key, AESGCM(key))
+    return cached
+
+def _parallel_executor(executor, n_jobs, total_size):
+    #executor for a batch worth parallelizing, or None to run it serially
+    global _aead_executor
+    if n_jobs < 2 or total_size < PARALLEL_AEAD_MIN_BYTES:
+        return None
+    if executor is None:
+        if os.cpu_count() == 1:
+            return None
+        if _aead_executor is None:
+            _aead_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        executor = _aead_executor
+    return executor
+
+def _aead_serial(fn, jobs, associated_data):
+    for nonce, src, dst in jobs:
+        fn(nonce, src, associated_data, dst)
+
+def _run_aead(fn, jobs, associated_data, executor=None):
+    """
+    fn(nonce, src, associated_data, dst) for every (nonce, src, dst) job; fn is an
+    AESGCM encrypt_into or decrypt_into.
+    """
+    executor = _parallel_executor(executor, len(jobs), sum(len(src) for _, src, _ in jobs))
+    if executor is None:
+        _aead_serial(fn, jobs, associated_data)
+        return
+    #one contiguous chunk of jobs per worker keeps the per-task overhead off small messages
+    n_chunks = min(len(jobs), getattr(executor, '_max_workers', os.cpu_count()))
+    step = -(-len(jobs) // n_chunks)
+    chunks = [jobs[i:i + step] for i in range(0, len(jobs), step)]
+    list(executor.map(lambda chunk: _aead_serial(fn, chunk, associated_data), chunks))
+
 
 class DoubleRatchet:
-    def __init__(self, shared_key, group, g1, g2):
+    """
+    ratchet_send/ratchet_recv encrypt directly under the current chain keys and need
+    both sides to step the DH ratchet in lockstep. send_message/recv_message add counted
+    messages on top: each DH step starts a new epoch whose chain key seeds a symmetric
+    KDF chain (kdf_chain), giving message n of the epoch its own key. The receiver can
+    then take messages in any order: keys it steps over are kept in a bounded LRU keyed
+    by (epoch, n), and skip_message_keys derives many keys ahead in one call so a
+    backlog can be decrypted in parallel.
+    """
+
+    def __init__(self, shared_key, group, g1, g2, key_pool=None, max_skipped_keys=MAX_SKIPPED_KEYS):
 
         self.group = group
         self.g1 = g1
@@ -59,35 +136,233 @@ class DoubleRatchet:
         self.shared_key = shared_key.export()
         self.send_chain_key = shared_key.export()
         self.recv_chain_key = shared_key.export()
-        self.dh_key_pair = generate_key_pair(group, g2)
+        self.key_pool = key_pool
+        self._send_aead = None
+        self._recv_aead = None
+        #counted messages: [chain key, next message number] per epoch
+        self.send_epoch = 0
+        self._send_chain = [self.send_chain_key, 0]
+        self.recv_epoch = 0
+        self._recv_chains = OrderedDict({0: [self.recv_chain_key, 0]})
+        self._skipped_keys = OrderedDict()
+        self.max_skipped_keys = max_skipped_keys
+        self.dh_key_pair = self._new_key_pair()
         self.dh_private_key = self.dh_key_pair[0]
         self.dh_public_key = self.dh_key_pair[1]
     
+    def _new_key_pair(self):
+        if self.key_pool is not None:
+            return self.key_pool.pop()
+        return generate_key_pair(self.group, self.g2)
+
     def ratcher_send_key(self, peer_public_key):
 
         salt = generate_shared_key(self.dh_private_key, peer_public_key)
         self.send_chain_key = hkdf(self.send_chain_key, salt=salt.export())
+        self.send_epoch += 1
+        self._send_chain = [self.send_chain_key, 0]
         current_dh_public_key = self.dh_public_key
-        self.dh_key_pair = generate_key_pair(self.group, self.g2)
+        self.dh_key_pair = self._new_key_pair()
         self.dh_private_key = self.dh_key_pair[0]
         self.dh_public_key = self.dh_key_pair[1]
         return self.send_chain_key, current_dh_public_key
     
+    def _send_cipher(self):
+        self._send_aead = _cached_aead(self._send_aead, self.send_chain_key)
+        return self._send_aead[1]
+
+    def _recv_cipher(self):
+        self._recv_aead = _cached_aead(self._recv_aead, self.recv_chain_key)
+        return self._recv_aead[1]
+
     def ratchet_send(self, message):
-        message_key = self.send_chain_key
-        nonce, ciphertext = encrypt_message(message_key, message)
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = self._send_cipher().encrypt(nonce, message.encode(), b'')
         return nonce, ciphertext
 
+    def send_many(self, messages, associated_data=b'', buf=None, executor=None):
+        """
+        Encrypt a batch of messages (str or bytes) under the current send chain key with
+        one AESGCM context. Ciphertexts are written back to back into buf, a bytearray
+        that is allocated if missing or too small and can be passed again to reuse it,
+        and returned as (nonce, memoryview) pairs valid until buf is reused. Batches of
+        PARALLEL_AEAD_MIN_BYTES or more are spread over executor, or a shared thread pool.
+        Needs cryptography 47.0 or later for AESGCM.encrypt_into/decrypt_into.
+        """
+        data = [message.encode() if isinstance(message, str) else message for message in messages]
+        size = sum(len(d) for d in data) + AEAD_TAG_SIZE * len(data)
+        if buf is None or len(buf) < size:
+            buf = bytearray(size)
+        view = memoryview(buf)
+        nonces = os.urandom(NONCE_SIZE * len(data))
+
+        jobs = []
+        pos = 0
+        for i, d in enumerate(data):
+            end = pos + len(d) + AEAD_TAG_SIZE
+            jobs.append((nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE], d, view[pos:end]))
+            pos = end
+
+        _run_aead(self._send_cipher().encrypt_into, jobs, associated_data, executor)
+        return [(nonce, out) for nonce, _, out in jobs]
+
     def ratcher_recv_key(self, peer_public_key):
 
         salt = generate_shared_key(self.dh_private_key, peer_public_key)
         self.recv_chain_key = hkdf(self.recv_chain_key, salt=salt.export())
+        self.recv_epoch += 1
+        self._recv_chains[self.recv_epoch] = [self.recv_chain_key, 0]
+        while len(self._recv_chains) > MAX_RECV_CHAINS:
+            self._recv_chains.popitem(last=False)
         return self.recv_chain_key
     
     def ratchet_recv(self, nonce, ciphertext):
-        message_key = self.recv_chain_key
-        plaintext = decrypt_message(message_key, nonce, ciphertext)
-        return plaintext
+        plaintext = self._recv_cipher().decrypt(nonce, ciphertext, b'')
+        return plaintext.decode()
+
+    def recv_many(self, items, associated_data=b'', decode=True, buf=None, executor=None):
+        """
+        Decrypt a batch of (nonce, ciphertext) pairs under the current receive chain key,
+        the counterpart of send_many. Plaintexts are written into buf as in send_many;
+        with decode=False they are returned as memoryviews of it instead of str.
+        Raises cryptography's InvalidTag if any message fails to authenticate or is
+        shorter than a tag.
+        """
+        if any(len(ciphertext) < AEAD_TAG_SIZE for _, ciphertext in items):
+            raise InvalidTag()
+        size = sum(len(ciphertext) - AEAD_TAG_SIZE for _, ciphertext in items)
+        if buf is None or len(buf) < size:
+            buf = bytearray(size)
+        view = memoryview(buf)
+
+        jobs = []
+        pos = 0
+        for nonce, ciphertext in items:
+            end = pos + len(ciphertext) - AEAD_TAG_SIZE
+            jobs.append((nonce, ciphertext, view[pos:end]))
+            pos = end
+
+        _run_aead(self._recv_cipher().decrypt_into, jobs, associated_data, executor)
+        if decode:
+            return [str(out, 'utf-8') for _, _, out in jobs]
+        return [out for _, _, out in jobs]
+
+
+    def send_message(self, message, associated_data=b''):
+        """
+        Encrypt message (str or bytes) as the next counted message of the current epoch.
+        Returns (epoch, n, nonce, ciphertext); the receiver needs all four.
+        """
+        chain_key, n = self._send_chain
+        self._send_chain[0], message_key = kdf_chain(chain_key)
+        self._send_chain[1] = n + 1
+        data = message.encode() if isinstance(message, str) else message
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = AESGCM(message_key).encrypt(nonce, data, MESSAGE_HEADER.pack(self.send_epoch, n) + associated_data)
+        return self.send_epoch, n, nonce, ciphertext
+
+    def skip_message_keys(self, epoch, until):
+        """
+        Derive the keys of messages up to, not including, until of epoch in one pass and
+        keep them for out-of-order receipt. Raises ValueError for an epoch no longer
+        kept or for more than MAX_SKIP keys.
+        """
+        chain = self._skip_chain(epoch, until)
+        chain_key, n = chain
+        while n < until:
+            chain_key, self._skipped_keys[(epoch, n)] = kdf_chain(chain_key)
+            n += 1
+        chain[0], chain[1] = chain_key, max(n, chain[1])
+        self._evict_skipped_keys()
+
+    def _skip_chain(self, epoch, until):
+        chain = self._recv_chains.get(epoch)
+        if chain is None:
+            raise ValueError("Receiving chain of epoch {} is not kept".format(epoch))
+        if until - chain[1] > MAX_SKIP:
+            raise ValueError("Refusing to derive {} message keys ahead".format(until - chain[1]))
+        return chain
+
+    def _evict_skipped_keys(self):
+        while len(self._skipped_keys) > self.max_skipped_keys:
+            self._skipped_keys.popitem(last=False)
+
+    def _message_key(self, epoch, n):
+        key = self._skipped_keys.pop((epoch, n), None)
+        if key is not None:
+            return key
+        chain = self._recv_chains.get(epoch)
+        if chain is None or n < chain[1]:
+            raise ValueError("No key for message {} of epoch {}: already received, evicted or unknown".format(n, epoch))
+        self.skip_message_keys(epoch, n)
+        chain[0], key = kdf_chain(chain[0])
+        chain[1] = n + 1
+        return key
+
+    def _open_message(self, key, item, associated_data, decode):
+        epoch, n, nonce, ciphertext = item
+        plaintext = AESGCM(key).decrypt(nonce, ciphertext, MESSAGE_HEADER.pack(epoch, n) + associated_data)
+        return plaintext.decode() if decode else plaintext
+
+    def recv_message(self, epoch, n, nonce, ciphertext, associated_data=b'', decode=True):
+        """
+        Decrypt a counted message from send_message, in any order. Raises ValueError if
+        its key is gone (duplicate, evicted or too old) and cryptography's InvalidTag if
+        it does not authenticate, in which case its key is kept for a retry.
+        """
+        key = self._message_key(epoch, n)
+        try:
+            return self._open_message(key, (epoch, n, nonce, ciphertext), associated_data, decode)
+        except Exception:
+            self._skipped_keys[(epoch, n)] = key
+            raise
+
+    def recv_messages(self, items, associated_data=b'', decode=True, executor=None):
+        """
+        Decrypt a backlog of (epoch, n, nonce, ciphertext) counted messages. All keys are
+        derived first, in one pass per epoch; only the keys of messages missing from the
+        batch are kept as skipped keys, so the batch itself is never cut by eviction. The
+        decryptions then run on executor, or the shared thread pool for batches of
+        PARALLEL_AEAD_MIN_BYTES or more. Messages whose key is gone, that repeat an
+        earlier message of the batch or that fail to authenticate get None; deriving too
+        far ahead raises ValueError as in skip_message_keys, before any key is used.
+        """
+        wanted = {item[:2] for item in items}
+        untils = {}
+        for epoch, n in wanted:
+            chain = self._recv_chains.get(epoch)
+            if chain is not None and n >= chain[1]:
+                untils[epoch] = max(untils.get(epoch, 0), n + 1)
+        chains = {epoch: self._skip_chain(epoch, until) for epoch, until in untils.items()}
+
+        keys = {index: self._skipped_keys.pop(index) for index in wanted if index in self._skipped_keys}
+        for epoch, until in untils.items():
+            chain = chains[epoch]
+            chain_key, n = chain
+            while n < until:
+                chain_key, key = kdf_chain(chain_key)
+                (keys if (epoch, n) in wanted else self._skipped_keys)[(epoch, n)] = key
+                n += 1
+            chain[0], chain[1] = chain_key, n
+
+        def open_message(job):
+            key, item = job
+            if key is None:
+                return None
+            try:
+                return self._open_message(key, item, associated_data, decode)
+            except Exception:
+                self._skipped_keys[item[:2]] = key
+                return None
+
+        jobs = [(keys.pop(item[:2], None), item) for item in items]
+        executor = _parallel_executor(executor, len(jobs), sum(len(item[3]) for item in items))
+        if executor is None:
+            plaintexts = [open_message(job) for job in jobs]
+        else:
+            plaintexts = list(executor.map(open_message, jobs))
+        self._evict_skipped_keys()
+        return plaintexts
 
 
 if __name__ == "__main__":
@@ -110,23 +385,11 @@ if __name__ == "__main__":
 
     buyer_message_key = buyer_ratchet.ratcher_recv_key(seller_dh_pub)
 
-    seller_addr = "addr" + seller_message_key.hex()
-    seller_bitmap = get_binary_hash(seller_addr)
-
-    tree = smt.SparseMerkleTree(256)
+    mailbox = Mailbox()
+    mailbox.post(mailbox_address(seller_message_key), data, leaf_hash(data[1]))
+    epoch, root = mailbox.publish()
 
-    hash = sha256(data[1].hex())
-    proof = tree.update(data, hash, seller_bitmap) 
-
-    buyer_addr = "addr" + buyer_message_key.hex()
-    buyer_bitmap = get_binary_hash(buyer_addr)
-
-    data = tree.get_data(buyer_bitmap)
-    res = sha256(data[1].hex())
-    for i in range(len(proof)):
-        res = sha256(str(res+proof[i]))
-    if res == tree.get_root():
-        plaintext = buyer_ratchet.ratchet_recv(data[0], data[1])
+    delivery = mailbox.fetch(mailbox_address(buyer_message_key))
+    if delivery.root == root and delivery.verify(leaf_hash(delivery.data[1])):
+        plaintext = buyer_ratchet.ratchet_recv(delivery.data[0], delivery.data[1])
         print(plaintext)
-
-
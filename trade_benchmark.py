@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import argparse
+
+sys.path.append('./')
+sys.path.append('..')
+from trade import AEAD_TAG_SIZE, MAX_SKIP, DoubleRatchet, generate_parameters, generate_key_pair, generate_shared_key
+
+MESSAGE_SIZES = (64, 4 * 1024, 256 * 1024, 4 * 1024 * 1024)
+BATCH_BYTES = 64 * 1024 * 1024
+MAX_BATCH = 10000
+SEED = 0
+
+SMOKE_MESSAGE_SIZES = (64, 4 * 1024)
+SMOKE_BATCH_BYTES = 1024 * 1024
+SMOKE_MAX_BATCH = 100
+
+
+def make_ratchets():
+    group, g1, g2 = generate_parameters()
+    seller_private_key, seller_public_key = generate_key_pair(group, g2)
+    buyer_private_key, buyer_public_key = generate_key_pair(group, g2)
+
+    seller = DoubleRatchet(generate_shared_key(seller_private_key, buyer_public_key), group, g1, g2)
+    buyer = DoubleRatchet(generate_shared_key(buyer_private_key, seller_public_key), group, g1, g2)
+
+    _, seller_dh_pub = seller.ratcher_send_key(buyer.dh_public_key)
+    buyer.ratcher_recv_key(seller_dh_pub)
+    return seller, buyer
+
+
+def report(name, n_messages, n_bytes, seconds):
+    print(f"{name}: {n_messages / seconds} messages/s, {n_bytes / seconds / 2**20} MB/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark DoubleRatchet per-message and batched encryption.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=MESSAGE_SIZES, help="message sizes in bytes")
+    parser.add_argument('--batch-bytes', type=int, default=BATCH_BYTES, help="bytes per batch, capped at --max-batch messages")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--smoke', action='store_true', help="small configuration that runs in seconds")
+    args = parser.parse_args()
+
+    if args.smoke:
+        args.sizes, args.batch_bytes, args.max_batch = SMOKE_MESSAGE_SIZES, SMOKE_BATCH_BYTES, SMOKE_MAX_BATCH
+
+    rng = random.Random(args.seed)
+    seller, buyer = make_ratchets()
+
+    for size in args.sizes:
+        n_messages = max(1, min(args.max_batch, args.batch_bytes // size))
+        #str messages, as ratchet_send/ratchet_recv take and return str
+        messages = [rng.randbytes(size // 2).hex() for _ in range(n_messages)]
+        n_bytes = n_messages * (size // 2 * 2)
+        print("Benchmarking {} messages of {} B".format(n_messages, size))
+
+        t0 = time.perf_counter()
+        sent = [seller.ratchet_send(message) for message in messages]
+        report("ratchet_send", n_messages, n_bytes, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        for nonce, ciphertext in sent:
+            buyer.ratchet_recv(nonce, ciphertext)
+        report("ratchet_recv", n_messages, n_bytes, time.perf_counter() - t0)
+
+        #buffers preallocated (and touched) outside the timed region, as a sender reusing them would
+        send_buf = bytearray(n_bytes + AEAD_TAG_SIZE * n_messages)
+        recv_buf = bytearray(n_bytes)
+
+        t0 = time.perf_counter()
+        sent = seller.send_many(messages, buf=send_buf)
+        report("send_many", n_messages, n_bytes, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        received = buyer.recv_many(sent, buf=recv_buf)
+        report("recv_many", n_messages, n_bytes, time.perf_counter() - t0)
+        assert received == messages
+
+        #counted messages drained as a shuffled backlog, within the skip bound
+        backlog = [seller.send_message(message) for message in messages[:MAX_SKIP]]
+        rng.shuffle(backlog)
+        t0 = time.perf_counter()
+        received = buyer.recv_messages(backlog)
+        report("recv_messages (backlog)", len(backlog), n_bytes * len(backlog) // n_messages, time.perf_counter() - t0)
+        assert None not in received
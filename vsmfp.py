@@ -1,9 +1,9 @@
 import time
 import random
 import string
-from smt import SparseMerkleTree,SparseMerkleTreeNode
+from smt import SparseMerkleTree, verify_proof
 import os
-from hash import sha256, get_binary_hash
+from hash import hash_leaf_stream
 
 def generate_random_string(size):
 
@@ -20,28 +20,24 @@ if __name__ == "__main__":
 
         data = generate_random_string(size)
 
-        bitmap = get_binary_hash(data)
-
         start_time = time.time()
-        hash_value = sha256(data)
+        hash_value, bitmap = hash_leaf_stream(data)
         proof = smt.update(data, hash_value, bitmap)
         end_time = time.time()
 
         print(f"send execution time for {label} data: {end_time - start_time} seconds")
 
         start_time = time.time()
-        proof1=smt.get_proof(smt.root, bitmap)
+        proof1=smt.get_proof(bitmap)
         retrieved_data = smt.get_data(bitmap)
         end_time = time.time()
 
         print(f"receive execution time for {label} data: {end_time - start_time} seconds")
 
         root=smt.get_root()
-        res = hash_value
         start_time = time.time()
-        for i in range(len(proof)):
-            res = sha256(str(res + proof[-i-1]))
+        res = verify_proof(root, hash_value, bitmap, proof)
         end_time = time.time()
 
         print(f"verification execution time for {label} data: {end_time - start_time} seconds")
-        print(res==root)
\ No newline at end of file
+        print(res)
\ No newline at end of file
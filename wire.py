@@ -0,0 +1,157 @@
+import mmap
+import struct
+from typing import Iterator, List, Tuple, Union
+
+from bplib.bp import G1Elem
+from match import DOC_ID_SIZE
+
+
+MAGIC = b'CRPW'
+HEADER = struct.Struct(">4sBI")
+
+MSG_QUERY = 1
+MSG_REPLY = 2
+MSG_POWERS = 3
+MSG_TAGS = 4
+
+TAG_SIZE = 64 #blake2b digest produced by kwd_encode
+TAG_RECORD_SIZE = DOC_ID_SIZE + TAG_SIZE
+
+
+def _header(msg_type, count) -> bytes:
+    return HEADER.pack(MAGIC, msg_type, count)
+
+
+def read_header(buf, msg_type) -> int:
+    if len(buf) < HEADER.size:
+        raise ValueError("Truncated header: {} bytes".format(len(buf)))
+    magic, found_type, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("Not a CRPPS message")
+    if found_type != msg_type:
+        raise ValueError("Expected message type {}, got {}".format(msg_type, found_type))
+    return count
+
+
+def _pack_points(points:List[bytes]) -> bytes:
+    return b''.join(bytes((len(pt),)) + pt for pt in points)
+
+
+def _unpack_points(buf, pos, count) -> Tuple[List[bytes], int]:
+    points = []
+    for _ in range(count):
+        if pos >= len(buf) or pos + 1 + buf[pos] > len(buf):
+            raise ValueError("Truncated message: {} of {} points".format(len(points), count))
+        size = buf[pos]
+        points.append(bytes(buf[pos + 1:pos + 1 + size]))
+        pos += 1 + size
+    return points, pos
+
+
+def _check_end(buf, pos):
+    if pos != len(buf):
+        raise ValueError("{} trailing bytes after message".format(len(buf) - pos))
+
+
+def encode_points(points:List[bytes], msg_type:int=MSG_QUERY) -> bytes:
+    """
+    Encode a query or a reply: a list of exported (compressed) G1 points,
+    each prefixed with its one-byte length.
+    """
+    return _header(msg_type, len(points)) + _pack_points(points)
+
+
+def decode_points(buf, msg_type:int=MSG_QUERY) -> List[bytes]:
+    count = read_header(buf, msg_type)
+    points, pos = _unpack_points(buf, HEADER.size, count)
+    _check_end(buf, pos)
+    return points
+
+
+def encode_powers(powers:List[List[G1Elem]]) -> bytes:
+    rows = [struct.pack(">H", len(row)) + _pack_points([elem.export() for elem in row]) for row in powers]
+    return _header(MSG_POWERS, len(powers)) + b''.join(rows)
+
+
+def decode_powers(buf, group) -> List[List[G1Elem]]:
+    count = read_header(buf, MSG_POWERS)
+    pos = HEADER.size
+    powers = []
+    for _ in range(count):
+        if pos + 2 > len(buf):
+            raise ValueError("Truncated message: {} of {} rows".format(len(powers), count))
+        (row_len,) = struct.unpack_from(">H", buf, pos)
+        row, pos = _unpack_points(buf, pos + 2, row_len)
+        powers.append([G1Elem.from_bytes(pt, group) for pt in row])
+    _check_end(buf, pos)
+    return powers
+
+
+def encode_tags(tags:List[Tuple[int, bytes]]) -> bytes:
+    """
+    Encode published tags as fixed-size DOC_ID_SIZE + TAG_SIZE records.
+    """
+    return _header(MSG_TAGS, len(tags)) + b''.join(
+        doc_id.to_bytes(DOC_ID_SIZE, byteorder="big") + tag for doc_id, tag in tags
+    )
+
+
+def write_tags(path:str, tags:List[Tuple[int, bytes]]):
+    with open(path, 'wb') as fd:
+        fd.write(encode_tags(tags))
+
+
+class PublishedTags:
+    """
+    Read-only, zero-copy view over encoded published tags, either an in-memory buffer
+    or a memory-mapped file. Tags are returned as memoryview slices of the buffer; they
+    hash and compare like bytes, so the view can be fed straight to PublishedIndex.
+    With raw=True the buffer holds bare records without a header, as written by a file
+    sink of Seller.attr_issue_stream. Drop every returned tag before calling close().
+    """
+
+    def __init__(self, buf:Union[bytes, bytearray, memoryview, mmap.mmap], raw:bool=False):
+        self._buf = buf
+        self._view = memoryview(buf).toreadonly()
+        if raw:
+            self.count, rest = divmod(len(self._view), TAG_RECORD_SIZE)
+            start = 0
+        else:
+            self.count = read_header(self._view, MSG_TAGS)
+            rest = len(self._view) - HEADER.size - self.count * TAG_RECORD_SIZE
+            start = HEADER.size
+        if rest != 0:
+            raise ValueError("Truncated tag message: {} records expected".format(self.count))
+        self._records = self._view[start:]
+
+    @classmethod
+    def open(cls, path:str, raw:bool=False) -> "PublishedTags":
+        with open(path, 'rb') as fd:
+            return cls(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ), raw)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i) -> Tuple[int, memoryview]:
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        pos = i * TAG_RECORD_SIZE
+        doc_id = int.from_bytes(self._records[pos:pos + DOC_ID_SIZE], byteorder="big")
+        return doc_id, self._records[pos + DOC_ID_SIZE:pos + TAG_RECORD_SIZE]
+
+    def __iter__(self) -> Iterator[Tuple[int, memoryview]]:
+        records = self._records
+        for pos in range(0, self.count * TAG_RECORD_SIZE, TAG_RECORD_SIZE):
+            yield int.from_bytes(records[pos:pos + DOC_ID_SIZE], byteorder="big"), records[pos + DOC_ID_SIZE:pos + TAG_RECORD_SIZE]
+
+    def close(self):
+        self._records.release()
+        self._view.release()
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()